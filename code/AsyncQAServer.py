@@ -0,0 +1,127 @@
+from aiohttp import web
+import os
+import json
+import asyncio
+import contextlib
+import contextvars
+
+import QAServer as qaserver
+import TableQA as tqa
+import CoreNLPLayer as cnlplayer
+import word2vecLayer as w2vlayer
+import Metrics
+import Tracing
+
+# Same endpoints as QAServer, served from one asyncio event loop: a question waiting on
+# CoreNLP, word2vec or Sempre does not hold a thread.
+ASYNC_RUN_PORT = qaserver.FLASK_RUN_PORT
+# Questions answered at once. The dictionary, lexicon and charts are shared, so a pipeline is cheap
+# and this is set high; the limits of the upstream clients (e.g. CoreNLPLayer.ASYNC_MAX_IN_FLIGHT)
+# bound the real concurrency.
+ASYNC_MAX_QUESTIONS = int(os.environ.get("QA_ASYNC_MAX_QUESTIONS", 1024))
+
+def run_blocking(function, *args):
+    # Loading charts, building pipelines and SQLite lookups run next to the event loop, in the request's context
+    return asyncio.get_running_loop().run_in_executor(None, contextvars.copy_context().run, function, *args)
+
+class AsyncPipelinePool:
+    # Lends pipelines to coroutines. A request waits for its turn without blocking the loop and has
+    # its pipeline to itself across every await until it is answered. The pool behind it is its own
+    # and may grow to as many pipelines as questions are let in, so acquiring never blocks a thread.
+    def __init__(self, max_size = ASYNC_MAX_QUESTIONS):
+        self.max_size = max_size
+        self.semaphore = asyncio.Semaphore(max_size)
+        self.lock = asyncio.Lock()
+        self.pipeline_pool = None
+
+    async def get_pipeline_pool(self):
+        async with self.lock:
+            if self.pipeline_pool == None:
+                self.pipeline_pool = await run_blocking(qaserver.PipelinePool, min(qaserver.PIPELINE_POOL_SIZE, self.max_size), self.max_size)
+        return self.pipeline_pool
+
+    @contextlib.asynccontextmanager
+    async def pipeline(self):
+        async with self.semaphore:
+            pipeline_pool = await self.get_pipeline_pool()
+            qa_system = await run_blocking(pipeline_pool.acquire)
+            try:
+                yield qa_system
+            finally:
+                pipeline_pool.release(qa_system)
+
+    def stats(self):
+        if self.pipeline_pool == None:
+            return None
+        return self.pipeline_pool.stats()
+
+async_pipeline_pool = None
+
+def get_async_pipeline_pool():
+    # Created inside the event loop that serves the requests
+    global async_pipeline_pool
+    if async_pipeline_pool == None:
+        async_pipeline_pool = AsyncPipelinePool()
+    return async_pipeline_pool
+
+async def answer_question_async(question, trace = False):
+    if trace:
+        with Tracing.trace() as request_trace:
+            result = await answer_question_async(question)
+        result["trace"] = request_trace.to_list()
+        return result
+    async with get_async_pipeline_pool().pipeline() as qa_system:
+        await run_blocking(qa_system.set_spec_handler_from_file, question["dataset"], question["specFile"], question["runtimeFile"], qaserver.BASE_DIR)
+        result = await qa_system.answer_query_within_async(question["query"], question.get("answer"), qaserver.question_timeout(question), "Sempre", True)
+    return qaserver.make_result(question, result)
+
+async def query_vis_sempre(request):
+    result = await answer_question_async(request.query, qaserver.is_trace_requested(request.query, request.headers))
+
+    callback = request.query['callback']
+    content = str(callback) + '(' + json.dumps(result) + ')'
+    return web.Response(text = content, content_type = 'application/javascript')
+
+async def stats(request):
+    result = qaserver.collect_stats()
+    result["asyncPipelinePool"] = get_async_pipeline_pool().stats()
+    result["asyncCoreNLP"] = cnlplayer.get_shared_async_parser().stats()
+    return web.json_response(result)
+
+async def debug_profile(request):
+    if not Tracing.is_debug_token(request.query.get("token")):
+        raise web.HTTPNotFound()
+    seconds = Tracing.parse_profile_seconds(request.query.get("seconds"))
+    if seconds == None:
+        raise web.HTTPBadRequest(text = "seconds must be a positive number")
+    # Sampled from a worker thread, so that the event loop keeps running and shows up in the stacks
+    collapsed_stacks = await asyncio.get_running_loop().run_in_executor(None, Tracing.sample_stacks, seconds)
+    return web.Response(text = collapsed_stacks, content_type = 'text/plain')
+
+async def ready(request):
+    warm_up_stats = qaserver.warm_up.stats()
+    return web.json_response(warm_up_stats, status = 200 if warm_up_stats["ready"] else 503)
+
+async def metrics(request):
+    return web.Response(text = Metrics.registry.render(), content_type = 'text/plain')
+
+async def close_client_sessions(app):
+    # The aiohttp sessions of the upstream clients were opened on this loop and must be closed on it
+    await tqa.sempre_session_pool.close_async()
+    await w2vlayer.close_backend_async()
+    await cnlplayer.get_shared_async_parser().close()
+
+def make_app():
+    app = web.Application()
+    app.on_cleanup.append(close_client_sessions)
+    app.router.add_get("/query-vis-sempre", query_vis_sempre)
+    app.router.add_get("/stats", stats)
+    app.router.add_get("/ready", ready)
+    app.router.add_get("/metrics", metrics)
+    app.router.add_get("/debug/profile", debug_profile)
+    return app
+
+if __name__ == '__main__':
+    qaserver.get_pipeline_pool()
+    qaserver.start_warm_up()
+    web.run_app(make_app(), port = ASYNC_RUN_PORT)
@@ -1,30 +1,350 @@
-import nltk
-import nltk.parse.corenlp as cnlp
-import nltk.parse.stanford as snlp
+import os
+import sys
+import json
+import time
+import sqlite3
+import threading
+import asyncio
+import collections
+import concurrent.futures
+import requests
+from nltk.tree import Tree
+from nltk.parse.dependencygraph import DependencyGraph
 
+import Metrics
+import Tracing
+import Deadline
+
+# Both parses (and the lemmas) come from a single annotation request
+ANNOTATORS = "tokenize,ssplit,pos,lemma,parse,depparse"
+SYNTACTIC_ANNOTATORS = "tokenize,ssplit,pos,lemma,parse"
+DEPENDENCY_ANNOTATORS = "tokenize,ssplit,pos,lemma,depparse"
+CORENLP_POOL_SIZE = 16
+CORENLP_TIMEOUT = 60
+# Batch parsing: questions per CoreNLP document, and documents in flight at once
+BATCH_CHUNK_SIZE = 50
+BATCH_MAX_IN_FLIGHT = 4
+# Async client: per-call deadline in seconds and parses in flight at once
+ASYNC_TIMEOUT = 10
+ASYNC_MAX_IN_FLIGHT = 16
+PARSE_CACHE_SIZE = 10000
+# Set to a file name to keep parses across restarts
+PARSE_CACHE_PATH = os.environ.get("CORENLP_CACHE_PATH")
+
+def normalize_query(query):
+	return " ".join(query.split())
+
+def serialize_syntactic_parse(syntactic_parse_tree):
+	return " ".join(str(syntactic_parse_tree).split())
+
+def deserialize_syntactic_parse(serialized_tree):
+	return Tree.fromstring(serialized_tree)
+
+def serialize_dependency_parse(dependency_parse_tree):
+	rows = []
+	for address in range(1, len(dependency_parse_tree.nodes)):
+		node = dependency_parse_tree.nodes[address]
+		rows.append([node["word"], node["lemma"], node["ctag"], node["tag"], node["head"], node["rel"]])
+	return json.dumps(rows, separators = (",", ":"))
+
+def make_dependency_parse(rows):
+	# Same 10-column layout that nltk's CoreNLPDependencyParser builds its graphs from
+	lines = []
+	for word, lemma, ctag, tag, head, rel in rows:
+		lines.append("\t".join(["_", word, lemma, ctag, tag, "_", str(head), rel, "_", "_"]))
+	return DependencyGraph(lines, cell_separator = "\t")
+
+def deserialize_dependency_parse(serialized_graph):
+	return make_dependency_parse(json.loads(serialized_graph))
+
+def make_parses(sentence):
+	# Constituency tree and dependency graph from one sentence of CoreNLP's JSON output
+	syntactic_parse_tree = Tree.fromstring(sentence["parse"])
+	rows = []
+	for dependency in sorted(sentence["basicDependencies"], key = lambda dependency: dependency["dependent"]):
+		token = sentence["tokens"][dependency["dependent"] - 1]
+		rows.append([token["word"], token["lemma"], token["pos"], token["pos"], dependency["governor"], dependency["dep"]])
+	return syntactic_parse_tree, make_dependency_parse(rows)
+
+SERIALIZERS = {
+	SYNTACTIC_ANNOTATORS: (serialize_syntactic_parse, deserialize_syntactic_parse),
+	DEPENDENCY_ANNOTATORS: (serialize_dependency_parse, deserialize_dependency_parse)
+}
+
+class ParseCache:
+	def __init__(self, max_size = PARSE_CACHE_SIZE, db_path = None):
+		# Parses are kept as objects in memory and serialized in the optional SQLite store
+		self.max_size = max_size
+		self.entries = collections.OrderedDict()
+		self.lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+		self.db_path = db_path
+		self.db = None
+		if db_path != None:
+			self.db = sqlite3.connect(db_path, check_same_thread = False)
+			self.db.execute("CREATE TABLE IF NOT EXISTS parses (annotators TEXT, query TEXT, parse TEXT, PRIMARY KEY (annotators, query))")
+			self.db.commit()
+
+	def close(self):
+		# Called before a fork: a SQLite connection must not be used or closed in a child process
+		with self.lock:
+			if self.db != None:
+				self.db.close()
+				self.db = None
+
+	def reconnect(self):
+		# Each process opens its own connection after the fork
+		with self.lock:
+			if self.db_path != None:
+				self.db = sqlite3.connect(self.db_path, check_same_thread = False)
+
+	def _remember(self, key, parse):
+		self.entries[key] = parse
+		self.entries.move_to_end(key)
+		while len(self.entries) > self.max_size:
+			self.entries.popitem(last = False)
+
+	def get(self, query, annotators):
+		key = (annotators, normalize_query(query))
+		with self.lock:
+			if key in self.entries:
+				self.entries.move_to_end(key)
+				self.hits += 1
+				return self.entries[key]
+			if self.db != None:
+				row = self.db.execute("SELECT parse FROM parses WHERE annotators = ? AND query = ?", key).fetchone()
+				if row != None:
+					parse = SERIALIZERS[annotators][1](row[0])
+					self._remember(key, parse)
+					self.hits += 1
+					return parse
+			self.misses += 1
+			return None
+
+	def put(self, query, annotators, parse):
+		key = (annotators, normalize_query(query))
+		with self.lock:
+			self._remember(key, parse)
+			if self.db != None:
+				self.db.execute("INSERT OR REPLACE INTO parses VALUES (?, ?, ?)", key + (SERIALIZERS[annotators][0](parse),))
+				self.db.commit()
+
+	def stats(self):
+		with self.lock:
+			lookups = self.hits + self.misses
+			return {
+				"hits": self.hits,
+				"misses": self.misses,
+				"hitRate": self.hits / float(lookups) if lookups > 0 else 0.0,
+				"size": len(self.entries),
+				"maxSize": self.max_size
+			}
+
+_shared_cache = None
+_shared_lock = threading.Lock()
+
+def get_shared_cache():
+	global _shared_cache
+	with _shared_lock:
+		if _shared_cache == None:
+			_shared_cache = ParseCache(PARSE_CACHE_SIZE, PARSE_CACHE_PATH)
+		return _shared_cache
+
+_shared_session = None
+
+def get_shared_session():
+	# Keep-alive connections to CoreNLP, reused by every QueryParser in the process
+	global _shared_session
+	with _shared_lock:
+		if _shared_session == None:
+			_shared_session = requests.Session()
+			adapter = requests.adapters.HTTPAdapter(pool_connections = 1, pool_maxsize = CORENLP_POOL_SIZE)
+			_shared_session.mount("http://", adapter)
+			_shared_session.mount("https://", adapter)
+		return _shared_session
 
 class QueryParser:
-	CORENLP_SERVER = "http://localhost:9000"
+	CORENLP_SERVER = os.environ.get("CORENLP_SERVER", "http://localhost:9000")
+
+	def __init__(self, cache = None, session = None):
+		# Shared by every QueryParser in the process unless given
+		self.cache = cache if cache != None else get_shared_cache()
+		self.session = session if session != None else get_shared_session()
+
+	def annotate(self, query):
+		syntactic_parse_tree = self.cache.get(query, SYNTACTIC_ANNOTATORS)
+		dependency_parse_tree = self.cache.get(query, DEPENDENCY_ANNOTATORS)
+		if syntactic_parse_tree != None and dependency_parse_tree != None:
+			return syntactic_parse_tree, dependency_parse_tree
+		properties = {"annotators": ANNOTATORS, "outputFormat": "json"}
+		with Metrics.upstream("corenlp"), Tracing.span("corenlp"):
+			try:
+				response = self.session.post(self.CORENLP_SERVER, params = {"properties": json.dumps(properties)}, data = normalize_query(query).encode("utf-8"), timeout = Deadline.timeout(CORENLP_TIMEOUT, "corenlp"))
+			except requests.Timeout:
+				raise Deadline.DeadlineExceeded("corenlp")
+			response.raise_for_status()
+		syntactic_parse_tree, dependency_parse_tree = make_parses(response.json()["sentences"][0])
+		self.cache.put(query, SYNTACTIC_ANNOTATORS, syntactic_parse_tree)
+		self.cache.put(query, DEPENDENCY_ANNOTATORS, dependency_parse_tree)
+		# Cached first, so that a late parse still serves the next request
+		Deadline.check("corenlp")
+		return syntactic_parse_tree, dependency_parse_tree
 
-	def __init__(self):
-		self.parser = cnlp.CoreNLPParser(url = self.CORENLP_SERVER)
-		self.dependency_parser = cnlp.CoreNLPDependencyParser(url = self.CORENLP_SERVER)
-		self.cache = {}
+	def annotate_document(self, queries):
+		# One question per line; eolonly keeps CoreNLP from splitting or merging them
+		properties = {"annotators": ANNOTATORS, "outputFormat": "json", "ssplit.eolonly": "true"}
+		document = "\n".join(normalize_query(query) for query in queries)
+		with Metrics.upstream("corenlp"), Tracing.span("corenlp"):
+			response = self.session.post(self.CORENLP_SERVER, params = {"properties": json.dumps(properties)}, data = document.encode("utf-8"), timeout = Deadline.timeout(CORENLP_TIMEOUT, "corenlp"))
+			response.raise_for_status()
+		sentences = response.json()["sentences"]
+		if len(sentences) != len(queries):
+			raise RuntimeError("CoreNLP returned " + str(len(sentences)) + " sentences for " + str(len(queries)) + " questions")
+		parses = []
+		for query, sentence in zip(queries, sentences):
+			syntactic_parse_tree, dependency_parse_tree = make_parses(sentence)
+			self.cache.put(query, SYNTACTIC_ANNOTATORS, syntactic_parse_tree)
+			self.cache.put(query, DEPENDENCY_ANNOTATORS, dependency_parse_tree)
+			parses.append((syntactic_parse_tree, dependency_parse_tree))
+		Deadline.check("corenlp")
+		return parses
+
+	def batch_parse(self, queries, chunk_size = BATCH_CHUNK_SIZE, max_in_flight = BATCH_MAX_IN_FLIGHT):
+		# Parses of many questions, in order, from a few multi-sentence documents sent concurrently
+		if len(queries) == 0:
+			return []
+		parses = {}
+		uncached_queries = []
+		for query in dict.fromkeys(normalize_query(query) for query in queries):
+			if query == "":
+				continue
+			syntactic_parse_tree = self.cache.get(query, SYNTACTIC_ANNOTATORS)
+			dependency_parse_tree = self.cache.get(query, DEPENDENCY_ANNOTATORS)
+			if syntactic_parse_tree != None and dependency_parse_tree != None:
+				parses[query] = (syntactic_parse_tree, dependency_parse_tree)
+			else:
+				uncached_queries.append(query)
+		chunks = [uncached_queries[chunk_start : chunk_start + chunk_size] for chunk_start in range(0, len(uncached_queries), chunk_size)]
+		with concurrent.futures.ThreadPoolExecutor(max_workers = max_in_flight) as executor:
+			chunk_futures = [executor.submit(self.annotate_document, chunk) for chunk in chunks]
+			for chunk, chunk_future in zip(chunks, chunk_futures):
+				try:
+					# Taken from the results rather than the cache, which may already have evicted them
+					parses.update(zip(chunk, chunk_future.result()))
+				except (RuntimeError, requests.RequestException):
+					# Fall back to one request per question for this chunk
+					for query in chunk:
+						parses[query] = self.annotate(query)
+		return [parses[normalize_query(query)] if normalize_query(query) in parses else self.annotate(query) for query in queries]
 
 	def syntactic_parse(self, query):
-		if query in self.cache and "syntactic" in self.cache[query]:
-			return self.cache[query]["syntactic"]
-		syntactic_parse_tree = next(self.parser.parse_text(query))
-		if not (query in self.cache):
-			self.cache[query] = {}
-		self.cache[query]["syntactic"] = syntactic_parse_tree
-		return syntactic_parse_tree
+		return self.annotate(query)[0]
 
 	def dependency_parse(self, query):
-		if query in self.cache and "dependency" in self.cache[query]:
-			return self.cache[query]["dependency"]
-		dependency_parse_tree = next(self.dependency_parser.parse_text(query))
-		if not (query in self.cache):
-			self.cache[query] = {}
-		self.cache[query]["dependency"] = dependency_parse_tree
-		return dependency_parse_tree
\ No newline at end of file
+		return self.annotate(query)[1]
+
+
+class AsyncQueryParser:
+	CORENLP_SERVER = QueryParser.CORENLP_SERVER
+
+	def __init__(self, cache = None, max_in_flight = ASYNC_MAX_IN_FLIGHT, timeout = ASYNC_TIMEOUT):
+		self.cache = cache if cache != None else get_shared_cache()
+		self.max_in_flight = max_in_flight
+		self.timeout = timeout
+		self.semaphore = asyncio.Semaphore(max_in_flight)
+		# Created on first use, inside the event loop
+		self.session = None
+		self.latency = Metrics.LatencyHistogram()
+		self.in_flight = 0
+		self.timeouts = 0
+		self.errors = 0
+
+	async def _post(self, query):
+		import aiohttp
+		if self.session == None:
+			self.session = aiohttp.ClientSession(connector = aiohttp.TCPConnector(limit = self.max_in_flight))
+		properties = {"annotators": ANNOTATORS, "outputFormat": "json"}
+		async with self.semaphore:
+			self.in_flight += 1
+			start_time = time.time()
+			try:
+				with Metrics.upstream("corenlp"), Tracing.span("corenlp"):
+					async with self.session.post(self.CORENLP_SERVER, params = {"properties": json.dumps(properties)}, data = normalize_query(query).encode("utf-8")) as response:
+						response.raise_for_status()
+						response_json = await response.json(content_type = None)
+			finally:
+				self.in_flight -= 1
+				self.latency.observe(time.time() - start_time)
+		return response_json
+
+	async def annotate(self, query, timeout = None):
+		# The deadline covers waiting for a free slot as well as the request itself,
+		# and is cut short by the deadline of the request being answered
+		loop = asyncio.get_running_loop()
+		# The cache may go to SQLite, which must not block the event loop
+		syntactic_parse_tree, dependency_parse_tree = await loop.run_in_executor(None, self._get_cached, query)
+		if syntactic_parse_tree != None and dependency_parse_tree != None:
+			return syntactic_parse_tree, dependency_parse_tree
+		try:
+			response_json = await asyncio.wait_for(self._post(query), Deadline.timeout(timeout if timeout != None else self.timeout, "corenlp"))
+		except asyncio.TimeoutError:
+			self.timeouts += 1
+			raise Deadline.DeadlineExceeded("corenlp")
+		except Exception:
+			self.errors += 1
+			raise
+		syntactic_parse_tree, dependency_parse_tree = make_parses(response_json["sentences"][0])
+		await loop.run_in_executor(None, self._put_cached, query, syntactic_parse_tree, dependency_parse_tree)
+		return syntactic_parse_tree, dependency_parse_tree
+
+	def _get_cached(self, query):
+		return self.cache.get(query, SYNTACTIC_ANNOTATORS), self.cache.get(query, DEPENDENCY_ANNOTATORS)
+
+	def _put_cached(self, query, syntactic_parse_tree, dependency_parse_tree):
+		self.cache.put(query, SYNTACTIC_ANNOTATORS, syntactic_parse_tree)
+		self.cache.put(query, DEPENDENCY_ANNOTATORS, dependency_parse_tree)
+
+	async def syntactic_parse(self, query, timeout = None):
+		return (await self.annotate(query, timeout))[0]
+
+	async def dependency_parse(self, query, timeout = None):
+		return (await self.annotate(query, timeout))[1]
+
+	async def close(self):
+		if self.session != None:
+			await self.session.close()
+			self.session = None
+
+	def stats(self):
+		return {
+			"inFlight": self.in_flight,
+			"maxInFlight": self.max_in_flight,
+			"timeouts": self.timeouts,
+			"errors": self.errors,
+			"p50": self.latency.percentile(0.5),
+			"p99": self.latency.percentile(0.99),
+			"latency": self.latency.snapshot()
+		}
+
+_shared_async_parser = None
+
+def get_shared_async_parser():
+	# One client per process, so that ASYNC_MAX_IN_FLIGHT bounds all async parses together
+	global _shared_async_parser
+	# Taken first: _shared_lock is not reentrant
+	cache = get_shared_cache()
+	with _shared_lock:
+		if _shared_async_parser == None:
+			_shared_async_parser = AsyncQueryParser(cache)
+		return _shared_async_parser
+
+if __name__ == '__main__':
+	# Parse every question of the dataset, e.g. to fill CORENLP_CACHE_PATH before an offline evaluation
+	qadata_file_name = sys.argv[1] if len(sys.argv) > 1 else "../dataset/qadata.json"
+	with open(qadata_file_name) as qadata_file:
+		questions = [qa_entry["question"] for qa_entry in json.load(qadata_file).values()]
+	start_time = time.time()
+	QueryParser().batch_parse(questions)
+	elapsed_time = time.time() - start_time
+	print("Parsed %d questions in %.1f s (%.1f questions/s)" % (len(questions), elapsed_time, len(questions) / max(elapsed_time, 1e-6)))
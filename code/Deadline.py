@@ -0,0 +1,43 @@
+import time
+import contextlib
+import contextvars
+
+# Absolute time by which the request being answered must be done, if it has a budget.
+# Context variables follow the request into asyncio tasks and into copied contexts.
+_current_deadline = contextvars.ContextVar("current_deadline", default = None)
+
+class DeadlineExceeded(TimeoutError):
+    # stage is the upstream call that ran out of time
+    def __init__(self, stage):
+        TimeoutError.__init__(self, "Timed out in " + stage)
+        self.stage = stage
+
+@contextlib.contextmanager
+def deadline(seconds):
+    token = _current_deadline.set(time.time() + seconds if seconds != None else None)
+    try:
+        yield
+    finally:
+        _current_deadline.reset(token)
+
+def remaining():
+    current_deadline = _current_deadline.get()
+    if current_deadline == None:
+        return None
+    return current_deadline - time.time()
+
+def check(stage):
+    # A requests timeout bounds each socket operation rather than the whole call, so an upstream
+    # that keeps sending slowly can reply after the deadline; such a reply counts as timed out
+    seconds_left = remaining()
+    if seconds_left != None and seconds_left <= 0:
+        raise DeadlineExceeded(stage)
+
+def timeout(default, stage):
+    # Timeout of one upstream call: its own default, cut short by the request deadline
+    seconds_left = remaining()
+    if seconds_left == None:
+        return default
+    if seconds_left <= 0:
+        raise DeadlineExceeded(stage)
+    return min(default, seconds_left)
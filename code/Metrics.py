@@ -0,0 +1,164 @@
+import os
+import time
+import threading
+import contextlib
+
+# Upper bounds of the latency buckets, in seconds
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, float("inf")]
+
+class LatencyHistogram:
+    def __init__(self, buckets = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.total = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, seconds):
+        with self.lock:
+            for bucket_idx, upper_bound in enumerate(self.buckets):
+                if seconds <= upper_bound:
+                    self.counts[bucket_idx] += 1
+                    break
+            self.count += 1
+            self.total += seconds
+
+    def percentile(self, fraction):
+        # Upper bound of the bucket holding the given fraction of observations. The overflow
+        # bucket reports the largest finite bound instead, since JSON has no infinity.
+        with self.lock:
+            if self.count == 0:
+                return 0.0
+            finite_buckets = [upper_bound for upper_bound in self.buckets if upper_bound != float("inf")]
+            target = fraction * self.count
+            cumulative = 0
+            for bucket_idx, upper_bound in enumerate(self.buckets):
+                cumulative += self.counts[bucket_idx]
+                if cumulative >= target:
+                    return min(upper_bound, finite_buckets[-1])
+            return finite_buckets[-1]
+
+    def snapshot(self):
+        with self.lock:
+            cumulative = 0
+            buckets = []
+            for bucket_idx, upper_bound in enumerate(self.buckets):
+                cumulative += self.counts[bucket_idx]
+                buckets.append(["+Inf" if upper_bound == float("inf") else upper_bound, cumulative])
+            return {"count": self.count, "sum": self.total, "buckets": buckets}
+
+# Instrumentation is a no-op unless enabled (QA_METRICS=1 or enable())
+enabled = os.environ.get("QA_METRICS", "0") == "1"
+
+def enable(is_enabled = True):
+    global enabled
+    enabled = is_enabled
+
+class MetricsRegistry:
+    def __init__(self):
+        # family name -> label value -> histogram / number
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+        self.lock = threading.Lock()
+
+    def histogram(self, family, label_value):
+        with self.lock:
+            family_histograms = self.histograms.setdefault(family, {})
+            if not label_value in family_histograms:
+                family_histograms[label_value] = LatencyHistogram()
+            return family_histograms[label_value]
+
+    def increment(self, family, label_value, amount = 1):
+        with self.lock:
+            family_counters = self.counters.setdefault(family, {})
+            family_counters[label_value] = family_counters.get(label_value, 0) + amount
+
+    def add_to_gauge(self, family, label_value, amount):
+        with self.lock:
+            family_gauges = self.gauges.setdefault(family, {})
+            family_gauges[label_value] = family_gauges.get(label_value, 0) + amount
+
+    def render(self):
+        # Prometheus text exposition format
+        lines = []
+        with self.lock:
+            histograms = {family: dict(self.histograms[family]) for family in self.histograms}
+            counters = {family: dict(self.counters[family]) for family in self.counters}
+            gauges = {family: dict(self.gauges[family]) for family in self.gauges}
+        for family in sorted(histograms):
+            label_name = METRIC_LABELS[family]
+            lines.append("# TYPE " + family + " histogram")
+            for label_value in sorted(histograms[family]):
+                snapshot = histograms[family][label_value].snapshot()
+                for upper_bound, cumulative in snapshot["buckets"]:
+                    lines.append('%s_bucket{%s="%s",le="%s"} %d' % (family, label_name, label_value, upper_bound, cumulative))
+                lines.append('%s_sum{%s="%s"} %f' % (family, label_name, label_value, snapshot["sum"]))
+                lines.append('%s_count{%s="%s"} %d' % (family, label_name, label_value, snapshot["count"]))
+        for metric_type, families in [("counter", counters), ("gauge", gauges)]:
+            for family in sorted(families):
+                label_name = METRIC_LABELS[family]
+                lines.append("# TYPE " + family + " " + metric_type)
+                for label_value in sorted(families[family]):
+                    lines.append('%s{%s="%s"} %d' % (family, label_name, label_value, families[family][label_value]))
+        return "\n".join(lines) + "\n"
+
+METRIC_LABELS = {
+    "qa_stage_latency_seconds": "stage",
+    "qa_stage_errors_total": "stage",
+    "qa_stage_in_flight": "stage",
+    "qa_upstream_latency_seconds": "service",
+    "qa_upstream_calls_total": "service",
+    "qa_upstream_errors_total": "service",
+    "qa_upstream_in_flight": "service"
+}
+
+registry = MetricsRegistry()
+
+@contextlib.contextmanager
+def _measure(kind, label_value):
+    registry.add_to_gauge("qa_" + kind + "_in_flight", label_value, 1)
+    if kind == "upstream":
+        registry.increment("qa_upstream_calls_total", label_value)
+    start_time = time.time()
+    try:
+        yield
+    except BaseException:
+        registry.increment("qa_" + kind + "_errors_total", label_value)
+        raise
+    finally:
+        registry.histogram("qa_" + kind + "_latency_seconds", label_value).observe(time.time() - start_time)
+        registry.add_to_gauge("qa_" + kind + "_in_flight", label_value, -1)
+
+_disabled = contextlib.nullcontext()
+
+def stage(stage_name):
+    # Latency, errors and in-flight count of one pipeline stage
+    if not enabled:
+        return _disabled
+    return _measure("stage", stage_name)
+
+def upstream(service_name):
+    # Calls, latency, errors and in-flight count of one upstream service
+    if not enabled:
+        return _disabled
+    return _measure("upstream", service_name)
+
+def process_memory_mb(pid = "self"):
+    # Pss splits each shared page among the processes mapping it, so the Pss of all
+    # workers adds up to what the pool really uses; Rss counts shared pages in full
+    memory = {}
+    try:
+        with open("/proc/" + str(pid) + "/smaps_rollup") as smaps_file:
+            for line in smaps_file:
+                fields = line.split()
+                if len(fields) == 3 and fields[2] == "kB":
+                    memory[fields[0][:-1]] = int(fields[1]) / 1024.0
+    except IOError:
+        return None
+    return {
+        "rss": memory.get("Rss", 0.0),
+        "pss": memory.get("Pss", 0.0),
+        "shared": memory.get("Shared_Clean", 0.0) + memory.get("Shared_Dirty", 0.0),
+        "private": memory.get("Private_Clean", 0.0) + memory.get("Private_Dirty", 0.0)
+    }
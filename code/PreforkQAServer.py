@@ -0,0 +1,142 @@
+import os
+import gc
+import sys
+import time
+import signal
+import socket
+import argparse
+import concurrent.futures
+
+import QAServer as qaserver
+import TableQA as tqa
+import CoreNLPLayer as cnlplayer
+import word2vecLayer as w2vlayer
+import Metrics
+
+# Production launcher: the dictionary, lexicon, color table, charts and caches are loaded and warmed
+# up once, then N worker processes are forked and share those pages copy-on-write.
+REPORT_INTERVAL = 60
+DEFAULT_WORKER_COUNT = os.cpu_count() or 1
+
+def reset_after_fork(worker_idx, worker_count):
+    # Sockets, SQLite connections, thread pools and Sempre sessions must not be shared with the parent
+    cnlplayer.get_shared_session().close()
+    cnlplayer.get_shared_cache().reconnect()
+    if w2vlayer.get_cache() != None:
+        w2vlayer.get_cache().reconnect()
+    tqa.sempre_session_pool.http_session.close()
+    tqa.sempre_session_pool.keep_share(worker_idx, worker_count)
+    # Threads do not survive a fork, so executors started in the parent would never run anything
+    tqa.speculation_executor = concurrent.futures.ThreadPoolExecutor(max_workers = tqa.SPECULATION_MAX_WORKERS)
+    qaserver.batch_executor = concurrent.futures.ThreadPoolExecutor(max_workers = qaserver.BATCH_MAX_WORKERS)
+
+def memory_report(worker_pids):
+    workers = []
+    for worker_idx, pid in enumerate(worker_pids):
+        memory = Metrics.process_memory_mb(pid)
+        # A worker that exited since the last reaping has no /proc entry anymore
+        if memory != None:
+            workers.append({"worker": worker_idx, "pid": pid, "memoryMB": memory})
+    pool = {
+        "workers": len(workers),
+        # What the workers really use together
+        "pssMB": sum(worker["memoryMB"]["pss"] for worker in workers),
+        # What as many independent copies of a worker would roughly use
+        "rssMB": sum(worker["memoryMB"]["rss"] for worker in workers),
+        "privateMB": sum(worker["memoryMB"]["private"] for worker in workers)
+    }
+    return {"parent": Metrics.process_memory_mb(), "workers": workers, "pool": pool}
+
+def print_memory_report(report):
+    for worker in report["workers"]:
+        print("worker %d (pid %d): rss %.0f MB, pss %.0f MB, shared %.0f MB, private %.0f MB" % (worker["worker"], worker["pid"], worker["memoryMB"]["rss"], worker["memoryMB"]["pss"], worker["memoryMB"]["shared"], worker["memoryMB"]["private"]))
+    pool = report["pool"]
+    print("pool of %d workers: pss %.0f MB (rss %.0f MB if nothing were shared), private %.0f MB" % (pool["workers"], pool["pssMB"], pool["rssMB"], pool["privateMB"]))
+    sys.stdout.flush()
+
+def close_before_fork():
+    # SQLite connections must not be carried into (or closed in) a child; the workers open their own
+    cnlplayer.get_shared_cache().close()
+    if w2vlayer.get_cache() != None:
+        w2vlayer.get_cache().close()
+
+def spawn_worker(worker_idx, worker_count, listen_socket, port):
+    from werkzeug.serving import make_server
+    pid = os.fork()
+    if pid == 0:
+        # The worker never returns into the launcher's loop, even when it fails
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            reset_after_fork(worker_idx, worker_count)
+            make_server("127.0.0.1", port, qaserver.app, threaded = True, fd = listen_socket.fileno()).serve_forever()
+        finally:
+            os._exit(1)
+    return pid
+
+def reap_workers(worker_pids, worker_count, listen_socket, port):
+    # Replaces every worker that exited since the last call
+    while True:
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            return
+        if pid == 0:
+            return
+        if pid in worker_pids:
+            worker_idx = worker_pids.index(pid)
+            print("worker %d (pid %d) exited with status %d, starting a new one" % (worker_idx, pid, status))
+            worker_pids[worker_idx] = spawn_worker(worker_idx, worker_count, listen_socket, port)
+
+def stop_workers(worker_pids):
+    for pid in worker_pids:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+    for pid in worker_pids:
+        try:
+            os.waitpid(pid, 0)
+        except ChildProcessError:
+            pass
+
+def serve_prefork(worker_count, port = qaserver.FLASK_RUN_PORT):
+    qaserver.get_pipeline_pool()
+    if qaserver.WARM_UP:
+        # In the parent, so that every worker starts warm; one Sempre session per worker and chart
+        qaserver.warm_up.run(worker_count)
+    else:
+        qaserver.warm_up.skip()
+    # Keeps the garbage collector from writing to (and so copying) every object inherited from the parent
+    gc.collect()
+    gc.freeze()
+
+    listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listen_socket.bind(("127.0.0.1", port))
+    listen_socket.listen(128)
+
+    close_before_fork()
+    # A process manager stops the launcher with SIGTERM; the workers must go down with it
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    worker_pids = [spawn_worker(worker_idx, worker_count, listen_socket, port) for worker_idx in range(worker_count)]
+    print("Started", worker_count, "workers on port", port)
+
+    try:
+        last_report_time = time.time()
+        while True:
+            time.sleep(1)
+            reap_workers(worker_pids, worker_count, listen_socket, port)
+            if time.time() - last_report_time >= REPORT_INTERVAL:
+                print_memory_report(memory_report(worker_pids))
+                last_report_time = time.time()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_workers(worker_pids)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Serve QAServer from pre-forked worker processes that share the loaded state")
+    parser.add_argument("--workers", type = int, default = DEFAULT_WORKER_COUNT)
+    parser.add_argument("--port", type = int, default = qaserver.FLASK_RUN_PORT)
+    args = parser.parse_args()
+    serve_prefork(args.workers, args.port)
@@ -1,38 +1,318 @@
 from flask import Flask, make_response, request, jsonify, current_app
+import os
 import json
+import math
+import time
+import queue
+import threading
+import contextlib
+import concurrent.futures
 
 import TableQA as tqa
+import SpecHandler as shandler
+import Metrics
+import Tracing
 
 app = Flask(__name__)
 FLASK_RUN_PORT = 5000;
 
 VIS_DICTIONARY_FILE_NAME = "./VisualAttributesDictionary.json"
+# Built offline by word2vec/build_lexicon.py; without it, similarities come from word2vec at query time
+VIS_LEXICON_FILE_NAME = "./VisualAttributesLexicon.json"
 VIS_BASE_DIR = "../data/vega-lite-example-gallery/runtime-data/"
 WIKITABLEQUESTIONS_BASE_DIR = "../sempre/lib/data/WikiTableQuestions/"
 BASE_DIR = "../"
+# TableQA instances built at startup and reused across requests; more requests than that wait for one
+PIPELINE_POOL_SIZE = 8
+# Questions of a batch request answered at once
+BATCH_MAX_WORKERS = 8
+# Overlap the meta answer, the CoreNLP parse and the Sempre session setup of each question
+SPECULATIVE_EXECUTION = os.environ.get("QA_SPECULATIVE", "0") == "1"
+# Charts loaded, registered with Sempre and asked a few questions before /ready reports ready
+CHART_LIST_FILE_NAME = "../dataset/chart-list.json"
+QADATA_FILE_NAME = "../dataset/qadata.json"
+WARM_UP = os.environ.get("QA_WARM_UP", "1") == "1"
+WARM_UP_QUESTIONS_PER_CHART = 2
+WARM_UP_MAX_WORKERS = 8
+# /ready stays at 503 unless this fraction of the charts (and at least one) loaded and registered with Sempre
+WARM_UP_MIN_CHART_FRACTION = float(os.environ.get("QA_WARM_UP_MIN_CHARTS", 0.0))
+# Latency budget of a question in seconds, unless the request passes its own timeout
+REQUEST_TIMEOUT = float(os.environ["QA_REQUEST_TIMEOUT"]) if "QA_REQUEST_TIMEOUT" in os.environ else None
+# Set to 1 (or pass trace=1) to get the spans of a request along with its answer
+TRACE_HEADER = "X-QA-Trace"
 
-@app.route("/query-vis-sempre", methods = ['GET'])
-def query_vis_sempre():
-    qa_system = tqa.TableQA(VIS_DICTIONARY_FILE_NAME, VIS_BASE_DIR)
+class PipelinePool:
+    def __init__(self, size, max_size = None):
+        self.pipelines = queue.Queue()
+        self.lock = threading.Lock()
+        self.max_size = max_size if max_size != None else size
+        # Pipelines built or being built, never more than max_size
+        self.reserved = size
+        self.created = 0
+        self.setup_seconds = 0.0
+        self.requests = 0
+        self.waits = 0
+        for pipeline_idx in range(size):
+            self.pipelines.put(self.create_pipeline())
+
+    def create_pipeline(self):
+        start_time = time.time()
+        vis_lexicon_file_name = VIS_LEXICON_FILE_NAME if os.path.exists(VIS_LEXICON_FILE_NAME) else None
+        pipeline = tqa.TableQA(VIS_DICTIONARY_FILE_NAME, VIS_BASE_DIR, vis_lexicon_file_name, SPECULATIVE_EXECUTION)
+        with self.lock:
+            self.created += 1
+            self.setup_seconds += time.time() - start_time
+        return pipeline
+
+    def acquire(self):
+        # Grows up to max_size when more requests are in flight than pipelines, then blocks
+        # until one is released
+        try:
+            pipeline = self.pipelines.get_nowait()
+        except queue.Empty:
+            with self.lock:
+                can_grow = self.reserved < self.max_size
+                if can_grow:
+                    self.reserved += 1
+                else:
+                    self.waits += 1
+            if can_grow:
+                try:
+                    pipeline = self.create_pipeline()
+                except BaseException:
+                    with self.lock:
+                        self.reserved -= 1
+                    raise
+            else:
+                pipeline = self.pipelines.get()
+        with self.lock:
+            self.requests += 1
+        return pipeline
+
+    def release(self, pipeline):
+        pipeline.reset()
+        self.pipelines.put(pipeline)
+
+    @contextlib.contextmanager
+    def pipeline(self):
+        pipeline = self.acquire()
+        try:
+            yield pipeline
+        finally:
+            self.release(pipeline)
+
+    def stats(self):
+        with self.lock:
+            setup_seconds_per_pipeline = self.setup_seconds / self.created if self.created > 0 else 0.0
+            return {
+                "pipelines": self.created,
+                "maxPipelines": self.max_size,
+                "idle": self.pipelines.qsize(),
+                "waits": self.waits,
+                "requests": self.requests,
+                "setupSecondsPerPipeline": setup_seconds_per_pipeline,
+                # What building a TableQA on every request would have cost on top
+                "setupSecondsSaved": max(0, self.requests - self.created) * setup_seconds_per_pipeline
+            }
+
+pipeline_pool = None
+pipeline_pool_lock = threading.Lock()
 
-    parsed_json = request.args
-    session_id = parsed_json["sessionId"]
-    question_id = parsed_json["questionId"]
-    dataset_name = parsed_json["dataset"]
-    spec_file_name = parsed_json["specFile"]
-    runtime_file_name = parsed_json["runtimeFile"]
+def get_pipeline_pool():
+    global pipeline_pool
+    with pipeline_pool_lock:
+        if pipeline_pool == None:
+            pipeline_pool = PipelinePool(PIPELINE_POOL_SIZE)
+        return pipeline_pool
 
-    qa_system.set_spec_handler_from_file(dataset_name, spec_file_name, runtime_file_name, BASE_DIR)
-    query = parsed_json["query"]
-    target_answer = parsed_json["answer"]
+def answer_question(question, trace = False):
+    # With trace, the result also lists the timed spans of the stages and upstream calls it took
+    if trace:
+        with Tracing.trace() as request_trace:
+            result = answer_question(question)
+        result["trace"] = request_trace.to_list()
+        return result
+    with get_pipeline_pool().pipeline() as qa_system:
+        qa_system.set_spec_handler_from_file(question["dataset"], question["specFile"], question["runtimeFile"], BASE_DIR)
+        result = qa_system.answer_query_within(question["query"], question.get("answer"), question_timeout(question), "Sempre", True)
+    return make_result(question, result)
 
-    vis_query, system_formula, system_answer = qa_system.answer_query(query, target_answer, "Sempre", True)
+def question_timeout(question):
+    return float(question["timeout"]) if question.get("timeout") != None else REQUEST_TIMEOUT
 
-    result = {"sessionId": session_id, "questionId": question_id, "visQuery": vis_query, "systemAnswer": system_answer, "formula": system_formula}
+def make_result(question, result):
+    # status is "timeout" when an upstream call ran out of time; the answer is then missing
+    return {"sessionId": question.get("sessionId"), "questionId": question.get("questionId"), "status": result["status"], "timedOutStage": result["timedOutStage"], "visQuery": result["visQuery"], "systemAnswer": result["answer"], "formula": result["formula"]}
+
+def is_trace_requested(args, headers):
+    return str(args.get("trace", headers.get(TRACE_HEADER, ""))).lower() in ["1", "true"]
+
+@app.route("/query-vis-sempre", methods = ['GET'])
+def query_vis_sempre():
+    result = answer_question(request.args, is_trace_requested(request.args, request.headers))
 
     callback = request.args['callback']
     content = str(callback) + '(' + json.dumps(result) + ')'
     return current_app.response_class(content, mimetype='application/javascript')
 
+batch_executor = concurrent.futures.ThreadPoolExecutor(max_workers = BATCH_MAX_WORKERS)
+
+@app.route("/query-vis-sempre-batch", methods = ['POST'])
+def query_vis_sempre_batch():
+    # Body: {"questions": [{"questionId", "query", "answer", "dataset", "specFile", "runtimeFile"}, ...]}.
+    # Fields given next to "questions" apply to every question that does not set them.
+    # One JSON line is streamed per question as soon as it is answered.
+    parsed_json = request.get_json(force = True)
+    shared_fields = {field: parsed_json[field] for field in parsed_json if field != "questions"}
+    questions = [dict(shared_fields, **question) for question in parsed_json["questions"]]
+    question_futures = {batch_executor.submit(answer_question, question, is_trace_requested(question, request.headers)): question for question in questions}
+
+    def generate_results():
+        for question_future in concurrent.futures.as_completed(question_futures):
+            question = question_futures[question_future]
+            try:
+                result = question_future.result()
+            except Exception as error:
+                result = {"sessionId": question.get("sessionId"), "questionId": question.get("questionId"), "error": type(error).__name__ + ": " + str(error)}
+            yield json.dumps(result) + "\n"
+
+    return current_app.response_class(generate_results(), mimetype = 'application/x-ndjson')
+
+class WarmUp:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ready = False
+        self.finished = False
+        self.charts = 0
+        self.required_charts = 0
+        self.failed_charts = []
+        self.chart_errors = {}
+        self.questions = 0
+        self.failed_questions = 0
+        self.seconds = None
+
+    @staticmethod
+    def find_runtime_file_name(dataset_name, spec_file_name):
+        # Tables extracted in Stage 1 are named after the spec ("27.json" -> "27.csv"); specs of
+        # several charts over one table ("59_0.json", "59_1.json") may share "59.csv"
+        spec_stem = os.path.splitext(spec_file_name)[0]
+        for runtime_file_name in [spec_stem + ".csv", spec_stem.split("_")[0] + ".csv"]:
+            if os.path.exists(shandler.SpecHandler.file_names(dataset_name, spec_file_name, runtime_file_name, BASE_DIR)[1]):
+                return runtime_file_name
+        return None
+
+    def load_chart(self, chart, sempre_sessions):
+        runtime_file_name = self.find_runtime_file_name(chart["dataset"], chart["filename"])
+        if runtime_file_name == None:
+            raise RuntimeError("No runtime table for " + chart["name"])
+        shandler.SpecHandler.from_file_cached(chart["dataset"], chart["filename"], runtime_file_name, BASE_DIR)
+        tqa.sempre_session_pool.warm_up("data/" + chart["dataset"] + "/runtime-data/" + runtime_file_name, sempre_sessions)
+        return runtime_file_name
+
+    def run(self, sempre_sessions_per_chart = 1):
+        start_time = time.time()
+        try:
+            with open(CHART_LIST_FILE_NAME) as chart_list_file:
+                charts = json.load(chart_list_file)
+            with open(QADATA_FILE_NAME) as qadata_file:
+                qadata = json.load(qadata_file)
+        except (IOError, ValueError) as error:
+            print("Skipping warm-up: " + str(error))
+            charts, qadata = [], {}
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers = WARM_UP_MAX_WORKERS) as executor:
+            chart_futures = {chart["name"]: executor.submit(self.load_chart, chart, sempre_sessions_per_chart) for chart in charts}
+            questions = []
+            for chart in charts:
+                try:
+                    runtime_file_name = chart_futures[chart["name"]].result()
+                except Exception as error:
+                    print("Warm-up failed for " + chart["name"] + ": " + str(error))
+                    with self.lock:
+                        self.failed_charts.append(chart["name"])
+                        self.chart_errors[chart["name"]] = type(error).__name__ + ": " + str(error)
+                    continue
+                with self.lock:
+                    self.charts += 1
+                sample_questions = [qa_entry["question"] for qa_entry in qadata.values() if qa_entry["chartName"] == chart["name"]][:WARM_UP_QUESTIONS_PER_CHART]
+                questions += [{"query": query, "dataset": chart["dataset"], "specFile": chart["filename"], "runtimeFile": runtime_file_name} for query in sample_questions]
+            # Primes the parse, similarity and answer caches and the CoreNLP/word2vec connections
+            for question_future in concurrent.futures.as_completed([executor.submit(answer_question, question) for question in questions]):
+                with self.lock:
+                    if question_future.exception() == None:
+                        self.questions += 1
+                    else:
+                        self.failed_questions += 1
+
+        with self.lock:
+            self.seconds = time.time() - start_time
+            self.finished = True
+            # A warm-up that reached none of the charts (e.g. with Sempre down) leaves the instance cold
+            self.required_charts = max(1, math.ceil(WARM_UP_MIN_CHART_FRACTION * len(charts))) if len(charts) > 0 else 0
+            self.ready = self.charts >= self.required_charts
+        print("Warm-up finished in %.1f s" % self.seconds)
+        if not self.ready:
+            print("Not ready: %d of %d charts warmed up, %d required" % (self.charts, len(charts), self.required_charts))
+
+    def skip(self):
+        with self.lock:
+            self.finished = True
+            self.ready = True
+
+    def stats(self):
+        with self.lock:
+            return {
+                "ready": self.ready,
+                "finished": self.finished,
+                "charts": self.charts,
+                "requiredCharts": self.required_charts,
+                "failedCharts": list(self.failed_charts),
+                "chartErrors": dict(self.chart_errors),
+                "questions": self.questions,
+                "failedQuestions": self.failed_questions,
+                "seconds": self.seconds
+            }
+
+warm_up = WarmUp()
+
+def start_warm_up():
+    # Runs in the background, so that /ready can answer while the charts load
+    if WARM_UP:
+        threading.Thread(target = warm_up.run, daemon = True).start()
+    else:
+        warm_up.skip()
+
+def collect_stats():
+    return {"pipelinePool": get_pipeline_pool().stats(), "chartCache": shandler.spec_handler_cache.stats(), "sempreSessions": tqa.sempre_session_pool.stats(), "answerCache": tqa.answer_cache.stats(), "warmUp": warm_up.stats(), "process": {"pid": os.getpid(), "memoryMB": Metrics.process_memory_mb()}}
+
+@app.route("/stats", methods = ['GET'])
+def stats():
+    return jsonify(collect_stats())
+
+@app.route("/ready", methods = ['GET'])
+def ready():
+    # 503 until the warm-up has finished and reached enough charts, so that load balancers skip a cold instance
+    warm_up_stats = warm_up.stats()
+    return jsonify(warm_up_stats), 200 if warm_up_stats["ready"] else 503
+
+@app.route("/metrics", methods = ['GET'])
+def metrics():
+    # Per-stage and per-upstream latency histograms; empty unless started with QA_METRICS=1
+    return current_app.response_class(Metrics.registry.render(), mimetype = 'text/plain; version=0.0.4')
+
+@app.route("/debug/profile", methods = ['GET'])
+def debug_profile():
+    # Samples every thread for a few seconds and returns collapsed stacks for flame graphs.
+    # Only served when QA_DEBUG_TOKEN is set, to callers that pass it as token.
+    if not Tracing.is_debug_token(request.args.get("token")):
+        return current_app.response_class("Not found", status = 404, mimetype = 'text/plain')
+    seconds = Tracing.parse_profile_seconds(request.args.get("seconds"))
+    if seconds == None:
+        return current_app.response_class("seconds must be a positive number", status = 400, mimetype = 'text/plain')
+    return current_app.response_class(Tracing.sample_stacks(seconds), mimetype = 'text/plain')
+
 if __name__ == '__main__':
-    app.run(debug = True, port = FLASK_RUN_PORT)
\ No newline at end of file
+    get_pipeline_pool()
+    start_warm_up()
+    # The reloader would run this module again in a child process, building the pool and warming up twice
+    app.run(debug = True, port = FLASK_RUN_PORT, use_reloader = False)
\ No newline at end of file
@@ -0,0 +1,185 @@
+import os
+import re
+import sys
+import json
+import time
+import random
+import hashlib
+import argparse
+import threading
+import urllib.parse
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Stand-ins for the upstream services of the pipeline. In "record" mode each stand-in forwards
+# to the real service and stores every request/response pair; in "replay" mode it answers from
+# the stored fixtures with injected latency. Point the pipeline at the stand-ins with
+# CORENLP_SERVER, WORD2VEC_SERVER and SEMPRE_SERVER.
+SERVICES = {
+    "corenlp": {"upstream": "http://localhost:9000", "port": 19000, "env": "CORENLP_SERVER", "path": ""},
+    "word2vec": {"upstream": "http://localhost:5005", "port": 15005, "env": "WORD2VEC_SERVER", "path": "/"},
+    "sempre": {"upstream": "http://localhost:8400", "port": 18400, "env": "SEMPRE_SERVER", "path": "/sempre"}
+}
+# Sempre hands out new session ids on every run, so replay falls back to matching without them,
+# on the table the session was opened for instead
+VOLATILE_PARAMS = ["sessionId"]
+SEMPRE_CONTEXT_QUERY = re.compile(r"^\(context \(graph tables\.TableKnowledgeGraph (.*)/\)\)$")
+
+def query_params(path):
+    return urllib.parse.parse_qsl(urllib.parse.urlsplit(path).query, keep_blank_values = True)
+
+def fixture_key(method, path, body, ignored_params = [], extra_params = []):
+    parsed_url = urllib.parse.urlsplit(path)
+    params = [(name, value) for name, value in query_params(path) if not name in ignored_params] + extra_params
+    return method + " " + parsed_url.path + "?" + urllib.parse.urlencode(sorted(params)) + " " + hashlib.sha1(body).hexdigest()
+
+class FixtureStore:
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.fixtures = {}
+        self.loose_fixtures = {}
+        # Table of every Sempre session id seen in a context response, recorded or replayed
+        self.session_tables = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if os.path.exists(file_name):
+            with open(file_name) as fixture_file:
+                for line in fixture_file:
+                    self._add(json.loads(line))
+
+    def _add(self, fixture):
+        self.fixtures[fixture["key"]] = fixture
+        self.loose_fixtures.setdefault(fixture["looseKey"], fixture)
+
+    def remember_session(self, path, response_body):
+        context_match = SEMPRE_CONTEXT_QUERY.match(dict(query_params(path)).get("q", ""))
+        if context_match == None:
+            return
+        try:
+            session_id = json.loads(response_body)["sessionId"]
+        except (ValueError, KeyError, TypeError):
+            return
+        self.session_tables[session_id] = context_match.group(1)
+
+    def loose_key(self, method, path, body):
+        # The same question on two tables must not share a fixture
+        session_id = dict(query_params(path)).get("sessionId")
+        if session_id == None:
+            return fixture_key(method, path, body, VOLATILE_PARAMS)
+        return fixture_key(method, path, body, VOLATILE_PARAMS, [("table", self.session_tables.get(session_id, ""))])
+
+    def record(self, method, path, body, status, content_type, response_body):
+        with self.lock:
+            self.remember_session(path, response_body)
+            fixture = {
+                "key": fixture_key(method, path, body),
+                "looseKey": self.loose_key(method, path, body),
+                "status": status,
+                "contentType": content_type,
+                "body": response_body.decode("utf-8")
+            }
+            self._add(fixture)
+            with open(self.file_name, "a") as fixture_file:
+                fixture_file.write(json.dumps(fixture) + "\n")
+
+    def lookup(self, method, path, body):
+        with self.lock:
+            fixture = self.fixtures.get(fixture_key(method, path, body))
+            if fixture == None:
+                fixture = self.loose_fixtures.get(self.loose_key(method, path, body))
+            if fixture == None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.remember_session(path, fixture["body"])
+            return fixture
+
+def make_handler(service_name, mode, store, upstream, latency_ms, jitter_ms):
+    class StandInHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def respond(self, status, content_type, body):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("Access-Control-Allow-Origin", "*")
+            self.end_headers()
+            self.wfile.write(body)
+
+        def handle_request(self, method):
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            if mode == "record":
+                upstream_request = urllib.request.Request(upstream + self.path, data = body if method == "POST" else None, method = method)
+                if self.headers.get("Content-Type") != None:
+                    upstream_request.add_header("Content-Type", self.headers.get("Content-Type"))
+                try:
+                    with urllib.request.urlopen(upstream_request) as upstream_response:
+                        status, content_type, response_body = upstream_response.status, upstream_response.headers.get("Content-Type", "application/json"), upstream_response.read()
+                except urllib.error.HTTPError as error:
+                    status, content_type, response_body = error.code, error.headers.get("Content-Type", "text/plain"), error.read()
+                store.record(method, self.path, body, status, content_type, response_body)
+                self.respond(status, content_type, response_body)
+                return
+            fixture = store.lookup(method, self.path, body)
+            time.sleep(max(0.0, latency_ms + random.uniform(-jitter_ms, jitter_ms)) / 1000.0)
+            if fixture == None:
+                print("[" + service_name + "] no fixture for " + method + " " + self.path, file = sys.stderr)
+                self.respond(404, "text/plain", b"No recorded response")
+                return
+            self.respond(fixture["status"], fixture["contentType"], fixture["body"].encode("utf-8"))
+
+        def do_GET(self):
+            self.handle_request("GET")
+
+        def do_POST(self):
+            self.handle_request("POST")
+
+    return StandInHandler
+
+def start_stand_ins(mode, fixture_dir, latencies = {}, jitter_ms = 0.0, service_names = SERVICES.keys()):
+    # Returns the servers (each serving on a daemon thread) and the environment that points clients to them
+    os.makedirs(fixture_dir, exist_ok = True)
+    servers = {}
+    environment = {}
+    for service_name in service_names:
+        service = SERVICES[service_name]
+        store = FixtureStore(os.path.join(fixture_dir, service_name + ".jsonl"))
+        handler = make_handler(service_name, mode, store, service["upstream"], latencies.get(service_name, 0.0), jitter_ms)
+        server = ThreadingHTTPServer(("127.0.0.1", service["port"]), handler)
+        server.daemon_threads = True
+        server.store = store
+        threading.Thread(target = server.serve_forever, daemon = True).start()
+        servers[service_name] = server
+        environment[service["env"]] = "http://localhost:" + str(service["port"]) + service["path"]
+    return servers, environment
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Record or replay the CoreNLP, word2vec and Sempre traffic of the pipeline")
+    parser.add_argument("mode", choices = ["record", "replay"])
+    parser.add_argument("--fixtures", default = "./fixtures")
+    parser.add_argument("--latency-ms", type = float, default = 0.0, help = "Injected latency of every replayed response")
+    parser.add_argument("--service-latency-ms", action = "append", default = [], metavar = "SERVICE=MS", help = "Per-service injected latency, e.g. sempre=120")
+    parser.add_argument("--jitter-ms", type = float, default = 0.0)
+    args = parser.parse_args()
+
+    latencies = {service_name: args.latency_ms for service_name in SERVICES}
+    for service_latency in args.service_latency_ms:
+        service_name, latency_ms = service_latency.split("=")
+        latencies[service_name] = float(latency_ms)
+    servers, environment = start_stand_ins(args.mode, args.fixtures, latencies, args.jitter_ms)
+    print("Stand-ins running in " + args.mode + " mode. Start the pipeline with:")
+    for name in environment:
+        print("  export " + name + "=" + environment[name])
+    try:
+        while True:
+            time.sleep(60)
+            if args.mode == "replay":
+                for service_name in servers:
+                    print(service_name, "hits:", servers[service_name].store.hits, "misses:", servers[service_name].store.misses)
+    except KeyboardInterrupt:
+        pass
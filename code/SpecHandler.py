@@ -1,8 +1,13 @@
+import os
 import json
+import hashlib
+import threading
+import collections
 from bidict import bidict
 
 import utils
 import DataTable as dtable
+import Tracing
 
 import xcolors
 
@@ -14,7 +19,9 @@ class SpecHandler:
         self.vis2data = bidict()
         self.color2data = {"field": None, "mapping": bidict()}
         self.marks = None
-        self.xcolors = xcolors.XColor()
+        self.xcolors = xcolors.shared_x_color
+        # Hash of the spec and runtime table contents; set by from_file
+        self.fingerprint = None
 
         self.extract_marks()
         self.extract_mapping()
@@ -340,18 +347,98 @@ class SpecHandler:
 
 
 
-    @classmethod
-    def from_file(cls, dataset_name, spec_file_name, runtime_file_name, base_directory = None):
+    @staticmethod
+    def file_names(dataset_name, spec_file_name, runtime_file_name, base_directory = None):
         spec_file_name = "data/" + dataset_name + "/specs/" + spec_file_name
         runtime_file_name = "data/" + dataset_name + "/runtime-data/" + runtime_file_name
 
         if base_directory != None:
             spec_file_name = base_directory + spec_file_name
             runtime_file_name = base_directory + runtime_file_name
+        return spec_file_name, runtime_file_name
 
-        with open(spec_file_name) as spec_file:
-            spec = json.load(spec_file)
+    @classmethod
+    def from_file(cls, dataset_name, spec_file_name, runtime_file_name, base_directory = None):
+        with Tracing.span("SpecHandler.from_file"):
+            spec_file_name, runtime_file_name = cls.file_names(dataset_name, spec_file_name, runtime_file_name, base_directory)
 
-        runtime_dtable = dtable.DataTable.from_file(runtime_file_name)
+            with open(spec_file_name, "rb") as spec_file:
+                spec_content = spec_file.read()
+            spec = json.loads(spec_content.decode("utf-8"))
 
-        return cls(dataset_name, spec, runtime_dtable, base_directory)
\ No newline at end of file
+            with Tracing.span("DataTable.from_file"):
+                runtime_dtable = dtable.DataTable.from_file(runtime_file_name)
+
+            spec_handler = cls(dataset_name, spec, runtime_dtable, base_directory)
+            with open(runtime_file_name, "rb") as runtime_file:
+                spec_handler.fingerprint = hashlib.sha1(spec_content + b"\0" + runtime_file.read()).hexdigest()
+            return spec_handler
+
+    @classmethod
+    def from_file_cached(cls, dataset_name, spec_file_name, runtime_file_name, base_directory = None):
+        return spec_handler_cache.get(dataset_name, spec_file_name, runtime_file_name, base_directory)
+
+SPEC_HANDLER_CACHE_SIZE = 64
+
+class SpecHandlerCache:
+    # Built SpecHandlers are only read by the pipeline, so one instance is shared by all requests
+    def __init__(self, max_size = SPEC_HANDLER_CACHE_SIZE):
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        # Called with the fingerprint of a chart whose files changed
+        self.invalidation_listeners = []
+
+    @staticmethod
+    def file_signature(file_name):
+        file_stat = os.stat(file_name)
+        return (file_stat.st_mtime_ns, file_stat.st_size)
+
+    def get(self, dataset_name, spec_file_name, runtime_file_name, base_directory = None):
+        key = (dataset_name, spec_file_name, runtime_file_name, base_directory)
+        spec_path, runtime_path = SpecHandler.file_names(dataset_name, spec_file_name, runtime_file_name, base_directory)
+        signature = (self.file_signature(spec_path), self.file_signature(runtime_path))
+        stale_fingerprint = None
+        with self.lock:
+            if key in self.entries:
+                cached_signature, spec_handler = self.entries[key]
+                if cached_signature == signature:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return spec_handler
+                del self.entries[key]
+                self.invalidations += 1
+                stale_fingerprint = spec_handler.fingerprint
+            self.misses += 1
+
+        spec_handler = SpecHandler.from_file(dataset_name, spec_file_name, runtime_file_name, base_directory)
+        if stale_fingerprint != None and stale_fingerprint != spec_handler.fingerprint:
+            for listener in self.invalidation_listeners:
+                listener(stale_fingerprint)
+        with self.lock:
+            self.entries[key] = (signature, spec_handler)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last = False)
+        return spec_handler
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+                "hitRate": self.hits / float(lookups) if lookups > 0 else 0.0,
+                "size": len(self.entries),
+                "maxSize": self.max_size
+            }
+
+spec_handler_cache = SpecHandlerCache()
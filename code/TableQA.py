@@ -1,6 +1,17 @@
+import os
 import re
 import csv
+import copy
+import time
+import asyncio
+import threading
+import contextvars
+import collections
+import concurrent.futures
 import requests
+import Metrics
+import Tracing
+import Deadline
 import CoreNLPLayer as cnlplayer
 import SpecHandler as shandler
 import VisualAttributeHandler as vahandler
@@ -68,14 +79,330 @@ class SempreQuery:
         query_id, query, table_file_name, correct_answer = data_list
         return cls(query_id, query, table_file_name, correct_answer)
 
+SEMPRE_SERVER = os.environ.get("SEMPRE_SERVER", "http://localhost:8400/sempre")
+# Sessions older than this are replaced, so that table graphs are rebuilt now and then
+SEMPRE_SESSION_TTL = 600
+SEMPRE_POOL_SIZE = 16
+SEMPRE_TIMEOUT = 60
+
+class SempreSessionPool:
+    # Idle Sempre sessions that already hold the graph of a table. A session serves one question at a time.
+    def __init__(self, server = SEMPRE_SERVER, ttl = SEMPRE_SESSION_TTL):
+        self.server = server
+        self.ttl = ttl
+        self.http_session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections = 1, pool_maxsize = SEMPRE_POOL_SIZE)
+        self.http_session.mount("http://", adapter)
+        self.http_session.mount("https://", adapter)
+        # Created on first use, inside the event loop
+        self.async_http_session = None
+        self.idle_sessions = {}
+        self.lock = threading.Lock()
+        self.created = 0
+        self.reused = 0
+        self.expired = 0
+        self.retries = 0
+        self.unused = 0
+        self.discarded = 0
+
+    def request(self, params, stage = "sempre_question"):
+        with Metrics.upstream("sempre"), Tracing.span("sempre"):
+            try:
+                sempre_response = self.http_session.get(self.server, params = params, timeout = Deadline.timeout(SEMPRE_TIMEOUT, stage))
+            except requests.Timeout:
+                raise Deadline.DeadlineExceeded(stage)
+            sempre_response.raise_for_status()
+            return sempre_response.json()
+
+    async def request_async(self, params, stage = "sempre_question"):
+        import aiohttp
+        if self.async_http_session == None:
+            self.async_http_session = aiohttp.ClientSession(timeout = aiohttp.ClientTimeout(total = SEMPRE_TIMEOUT))
+        with Metrics.upstream("sempre"), Tracing.span("sempre"):
+            try:
+                async with self.async_http_session.get(self.server, params = params, timeout = aiohttp.ClientTimeout(total = Deadline.timeout(SEMPRE_TIMEOUT, stage))) as sempre_response:
+                    sempre_response.raise_for_status()
+                    return await sempre_response.json(content_type = None)
+            except asyncio.TimeoutError:
+                raise Deadline.DeadlineExceeded(stage)
+
+    @staticmethod
+    def context_params(table_file_name):
+        return {"q": "(context (graph tables.TableKnowledgeGraph " + table_file_name + "/" + "))", "format": "json"}
+
+    def create_session(self, table_file_name):
+        response_json = self.request(self.context_params(table_file_name), "sempre_session")
+        with self.lock:
+            self.created += 1
+        return (response_json["sessionId"], time.time())
+
+    async def create_session_async(self, table_file_name):
+        response_json = await self.request_async(self.context_params(table_file_name), "sempre_session")
+        with self.lock:
+            self.created += 1
+        return (response_json["sessionId"], time.time())
+
+    def take_idle(self, table_file_name):
+        with self.lock:
+            idle_sessions = self.idle_sessions.get(table_file_name, [])
+            while len(idle_sessions) > 0:
+                session = idle_sessions.pop()
+                if time.time() - session[1] < self.ttl:
+                    self.reused += 1
+                    return session
+                self.expired += 1
+        return None
+
+    def acquire(self, table_file_name):
+        with Metrics.stage("sempre_session"), Tracing.span("sempre_session"):
+            session = self.take_idle(table_file_name)
+            if session != None:
+                return session, True
+            return self.create_session(table_file_name), False
+
+    async def acquire_async(self, table_file_name):
+        with Metrics.stage("sempre_session"), Tracing.span("sempre_session"):
+            session = self.take_idle(table_file_name)
+            if session != None:
+                return session, True
+            return await self.create_session_async(table_file_name), False
+
+    def release(self, table_file_name, session):
+        if time.time() - session[1] >= self.ttl:
+            return
+        with self.lock:
+            self.idle_sessions.setdefault(table_file_name, []).append(session)
+
+    def release_when_acquired(self, table_file_name, session_future):
+        # For a session acquired speculatively for a question that no longer needs it.
+        # Works on concurrent futures as well as asyncio tasks.
+        def release(session_future):
+            if session_future.cancelled() or session_future.exception() != None:
+                return
+            with self.lock:
+                self.unused += 1
+            self.release(table_file_name, session_future.result()[0])
+        session_future.add_done_callback(release)
+
+    def warm_up(self, table_file_name, session_count = 1):
+        sessions = [self.create_session(table_file_name) for session_idx in range(session_count)]
+        for session in sessions:
+            self.release(table_file_name, session)
+
+    def keep_share(self, share_idx, share_count):
+        # After a fork, each worker keeps a disjoint share of the inherited idle sessions,
+        # so that no Sempre session is used by two processes at once
+        with self.lock:
+            for table_file_name in self.idle_sessions:
+                self.idle_sessions[table_file_name] = self.idle_sessions[table_file_name][share_idx::share_count]
+
+    def invalidate(self, table_file_name = None):
+        with self.lock:
+            if table_file_name == None:
+                self.idle_sessions.clear()
+            else:
+                self.idle_sessions.pop(table_file_name, None)
+
+    def ask(self, table_file_name, query):
+        session, is_reused = self.acquire(table_file_name)
+        return self.ask_on_session(table_file_name, query, session, is_reused)
+
+    def discard(self, session):
+        # For a session whose state is unknown, e.g. one still busy with a question that timed out
+        with self.lock:
+            self.discarded += 1
+
+    def ask_once(self, query, session, is_reused):
+        # Sempre replies on the session id it was given and, after a restart, silently opens a new
+        # session without a table under that id. A reused session that fails or answers nothing may
+        # have been lost that way, so None is returned for it instead of the reply.
+        try:
+            with Metrics.stage("sempre_question"), Tracing.span("sempre_question"):
+                response_json = self.request({"q": query, "format": "json", "sessionId": session[0]})
+        except requests.ConnectionError:
+            # Sempre went away; none of the pooled sessions can be trusted anymore
+            self.invalidate()
+            raise
+        except (requests.HTTPError, ValueError):
+            if is_reused:
+                return None
+            raise
+        if is_reused and not "answer" in response_json:
+            return None
+        return response_json
+
+    def ask_on_session(self, table_file_name, query, session, is_reused):
+        # Asks on an acquired session and retries once on a new one if a reused session may have been
+        # lost. Only a session that replied goes back to the pool; a new session that replied without
+        # an answer still holds its table.
+        replied = False
+        try:
+            response_json = self.ask_once(query, session, is_reused)
+            if response_json == None:
+                with self.lock:
+                    self.retries += 1
+                self.discard(session)
+                session = None
+                with Metrics.stage("sempre_session"), Tracing.span("sempre_session"):
+                    session = self.create_session(table_file_name)
+                response_json = self.ask_once(query, session, False)
+            replied = True
+            # The session is free again even if its reply came too late
+            Deadline.check("sempre_question")
+            return response_json
+        finally:
+            if session != None:
+                if replied:
+                    self.release(table_file_name, session)
+                else:
+                    self.discard(session)
+
+    async def ask_async(self, table_file_name, query):
+        session, is_reused = await self.acquire_async(table_file_name)
+        return await self.ask_on_session_async(table_file_name, query, session, is_reused)
+
+    async def ask_once_async(self, query, session, is_reused):
+        import aiohttp
+        try:
+            with Metrics.stage("sempre_question"), Tracing.span("sempre_question"):
+                response_json = await self.request_async({"q": query, "format": "json", "sessionId": session[0]})
+        except aiohttp.ClientConnectionError:
+            self.invalidate()
+            raise
+        except (aiohttp.ClientResponseError, ValueError):
+            if is_reused:
+                return None
+            raise
+        if is_reused and not "answer" in response_json:
+            return None
+        return response_json
+
+    async def ask_on_session_async(self, table_file_name, query, session, is_reused):
+        replied = False
+        try:
+            response_json = await self.ask_once_async(query, session, is_reused)
+            if response_json == None:
+                with self.lock:
+                    self.retries += 1
+                self.discard(session)
+                session = None
+                with Metrics.stage("sempre_session"), Tracing.span("sempre_session"):
+                    session = await self.create_session_async(table_file_name)
+                response_json = await self.ask_once_async(query, session, False)
+            replied = True
+            return response_json
+        finally:
+            if session != None:
+                if replied:
+                    self.release(table_file_name, session)
+                else:
+                    self.discard(session)
+
+    async def close_async(self):
+        if self.async_http_session != None:
+            await self.async_http_session.close()
+            self.async_http_session = None
+
+    def stats(self):
+        with self.lock:
+            return {
+                "created": self.created,
+                "reused": self.reused,
+                "expired": self.expired,
+                "retries": self.retries,
+                "unused": self.unused,
+                "discarded": self.discarded,
+                "idle": sum(len(idle_sessions) for idle_sessions in self.idle_sessions.values()),
+                "tables": len(self.idle_sessions)
+            }
+
+sempre_session_pool = SempreSessionPool()
+
+# Threads that run the Sempre session setup and the question conversion next to each other
+SPECULATION_MAX_WORKERS = 32
+speculation_executor = concurrent.futures.ThreadPoolExecutor(max_workers = SPECULATION_MAX_WORKERS)
+
+ANSWER_CACHE_SIZE = 10000
+ANSWER_CACHE_TTL = 3600
+
+class AnswerCache:
+    # (vis_query, formula, answer) keyed by chart fingerprint, normalized question, core system and handle_visual
+    def __init__(self, max_size = ANSWER_CACHE_SIZE, ttl = ANSWER_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.invalidated = 0
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                stored_time, result = self.entries[key]
+                if time.time() - stored_time < self.ttl:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return result
+                del self.entries[key]
+                self.expired += 1
+            self.misses += 1
+            return None
+
+    def put(self, key, result):
+        with self.lock:
+            self.entries[key] = (time.time(), result)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last = False)
+
+    def invalidate_chart(self, fingerprint):
+        with self.lock:
+            stale_keys = [key for key in self.entries if key[0] == fingerprint]
+            for key in stale_keys:
+                del self.entries[key]
+            self.invalidated += len(stale_keys)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "expired": self.expired,
+                "invalidated": self.invalidated,
+                "hitRate": self.hits / float(lookups) if lookups > 0 else 0.0,
+                "size": len(self.entries),
+                "maxSize": self.max_size
+            }
+
+answer_cache = AnswerCache()
+# Answers of a chart whose spec or table changed on disk are dropped right away
+shandler.spec_handler_cache.invalidation_listeners.append(answer_cache.invalidate_chart)
+
 class TableQA:
-    SEMPRE_SESSION_IDS = {}
-    def __init__(self, vis_dictionary_file_name, table_base_dir = None):
+    def __init__(self, vis_dictionary_file_name, table_base_dir = None, vis_lexicon_file_name = None, speculative = False):
         self.qparser = cnlplayer.QueryParser()
+        # Overlap the meta answer, the question conversion and the Sempre session setup
+        self.speculative = speculative
         self.table_base_dir = table_base_dir
         self.table = None
         self.table_file_name = None
-        self.visual_attribute_handler = vahandler.VisualAttributeHandler(vis_dictionary_file_name)
+        # Visual query of the question being answered, kept for partial results
+        self.converted_query = None
+        self.visual_attribute_handler = vahandler.VisualAttributeHandler(vis_dictionary_file_name, vis_lexicon_file_name, self.qparser)
+
+    def reset(self):
+        # Forget the chart of the previous request so that the instance can be reused
+        self.table = None
+        self.table_file_name = None
+        self.converted_query = None
+        self.visual_attribute_handler.set_spec_handler(None)
 
     def change_table_base_dir(self, table_base_dir = None):
         self.table_base_dir = table_base_dir
@@ -98,32 +425,188 @@ class TableQA:
         self.table = self.visual_attribute_handler.spec_handler.runtime_dtable
         self.table_file_name = "data/" + dataset_name + "/runtime-data/" + runtime_file_name
 
+    def answer_cache_key(self, query, core_system, handle_visual):
+        # Only charts loaded from files have a fingerprint; other answers are not cached
+        spec_handler = self.visual_attribute_handler.spec_handler
+        if spec_handler == None or spec_handler.fingerprint == None:
+            return None
+        return (spec_handler.fingerprint, cnlplayer.normalize_query(query), core_system, handle_visual)
+
     def answer_query(self, query, target_answer, core_system = "Rule", handle_visual = False):
+        cache_key = self.answer_cache_key(query, core_system, handle_visual)
+        if cache_key != None:
+            cached_result = answer_cache.get(cache_key)
+            if cached_result != None:
+                return cached_result
+        result = self.compute_answer(query, target_answer, core_system, handle_visual)
+        if cache_key != None:
+            answer_cache.put(cache_key, result)
+        return result
+
+    def answer_query_within(self, query, target_answer, timeout = None, core_system = "Rule", handle_visual = False):
+        # Like answer_query, but every CoreNLP, word2vec and Sempre call gives up once timeout seconds
+        # have passed. An answer that ran out of time carries the furthest query it got to (the converted
+        # visual query or the raw query), and timedOutStage names the call that ran out.
+        self.converted_query = None
+        with Deadline.deadline(timeout):
+            try:
+                vis_query, formula, answer = self.answer_query(query, target_answer, core_system, handle_visual)
+            except Deadline.DeadlineExceeded as error:
+                return self.make_partial_result(query, error)
+        return {"status": "ok", "timedOutStage": None, "visQuery": vis_query, "formula": formula, "answer": answer}
+
+    async def answer_query_within_async(self, query, target_answer, timeout = None, core_system = "Rule", handle_visual = False):
+        self.converted_query = None
+        with Deadline.deadline(timeout):
+            try:
+                vis_query, formula, answer = await self.answer_query_async(query, target_answer, core_system, handle_visual)
+            except Deadline.DeadlineExceeded as error:
+                return self.make_partial_result(query, error)
+        return {"status": "ok", "timedOutStage": None, "visQuery": vis_query, "formula": formula, "answer": answer}
+
+    def make_partial_result(self, query, error):
+        vis_query = self.converted_query if self.converted_query != None else query
+        return {"status": "timeout", "timedOutStage": error.stage, "visQuery": vis_query, "formula": None, "answer": None}
+
+    def compute_answer(self, query, target_answer, core_system = "Rule", handle_visual = False):
         if self.table == None:
             raise RuntimeError("The context table for the query has not been set")
 
         if handle_visual:
             if self.visual_attribute_handler.spec_handler == None:
                 raise RuntimeError("The spec for the query has not been set")
-            meta_answer = self.visual_attribute_handler.attempt_meta_answer(query)
+            if self.speculative and core_system == "Sempre" and self.table_file_name != None:
+                return self.compute_answer_speculatively(query)
+            meta_answer = self.attempt_meta_answer(query)
             if meta_answer != None:
                 answer, formula = meta_answer
                 return query, formula, answer
-            input_query = self.visual_attribute_handler.convert_query(query)
+            input_query = self.convert_query(query)
         else:
             input_query = query
 
         if core_system == "Sempre":
             if self.table_file_name == None:
                 raise RuntimeError("The table file location has not been specified")
-            if self.table_file_name in self.SEMPRE_SESSION_IDS:
-                sempre_session_id = self.SEMPRE_SESSION_IDS[self.table_file_name]
-            else:
-                table_set_response = requests.get("http://localhost:8400/sempre", params = {"q": "(context (graph tables.TableKnowledgeGraph " + self.table_file_name + "/" + "))", "format": "json"})
-                sempre_session_id = table_set_response.json()["sessionId"]
-            sempre_qa_response = requests.get("http://localhost:8400/sempre", params = {"q": input_query, "format": "json", "sessionId": sempre_session_id})
-            answer = sempre_qa_response.json()["answer"]
+            answer = sempre_session_pool.ask(self.table_file_name, input_query)["answer"]
+            return self.make_sempre_result(input_query, answer)
+        else:
+            raise RuntimeError("Unhandled core system: " + str(core_system))
+
+    def attempt_meta_answer(self, query):
+        with Metrics.stage("attempt_meta_answer"), Tracing.span("attempt_meta_answer"):
+            return self.visual_attribute_handler.attempt_meta_answer(query)
+
+    def convert_query(self, query):
+        self.converted_query = self.convert_query_on(self.visual_attribute_handler, query)
+        return self.converted_query
+
+    async def convert_query_async(self, query):
+        self.converted_query = await self.convert_query_on_async(self.visual_attribute_handler, query)
+        return self.converted_query
+
+    @staticmethod
+    def convert_query_on(visual_attribute_handler, query):
+        # Leaves the pipeline alone, for work that may outlive the request it was started for
+        with Metrics.stage("convert_query"), Tracing.span("convert_query"):
+            return visual_attribute_handler.convert_query(query)
+
+    @staticmethod
+    async def convert_query_on_async(visual_attribute_handler, query):
+        with Metrics.stage("convert_query"), Tracing.span("convert_query"):
+            return await visual_attribute_handler.convert_query_async(query)
+
+    def own_visual_attribute_handler(self):
+        # The pipeline's handler is reset and given the next request's chart once this request is
+        # answered, while an abandoned speculative conversion may still be running
+        return copy.copy(self.visual_attribute_handler)
+
+    @staticmethod
+    def make_sempre_result(input_query, answer):
+        with Metrics.stage("parse_sempre_answer"):
             parsed_answer = parse_sempre_answer(answer["value"])
-            return input_query, answer["formula"], parsed_answer
+        return input_query, answer["formula"], parsed_answer
+
+    def abandon(self, session_future, convert_future):
+        # Stops whatever has not started yet; a session that is or will be acquired goes back to the pool.
+        # A parse already sent to CoreNLP still lands in the parse cache.
+        convert_future.cancel()
+        if not session_future.cancel():
+            sempre_session_pool.release_when_acquired(self.table_file_name, session_future)
+
+    def compute_answer_speculatively(self, query):
+        # The Sempre session does not depend on the question, and the conversion does not depend on
+        # the meta answer, so both are started right away; the meta answer is checked meanwhile.
+        # Only this thread touches the pipeline: the conversion returns its result.
+        session_future = speculation_executor.submit(contextvars.copy_context().run, sempre_session_pool.acquire, self.table_file_name)
+        convert_future = speculation_executor.submit(contextvars.copy_context().run, self.convert_query_on, self.own_visual_attribute_handler(), query)
+        try:
+            meta_answer = self.attempt_meta_answer(query)
+            if meta_answer != None:
+                self.abandon(session_future, convert_future)
+                answer, formula = meta_answer
+                return query, formula, answer
+            input_query = convert_future.result()
+            self.converted_query = input_query
+        except BaseException:
+            self.abandon(session_future, convert_future)
+            raise
+        session, is_reused = session_future.result()
+        answer = sempre_session_pool.ask_on_session(self.table_file_name, input_query, session, is_reused)["answer"]
+        return self.make_sempre_result(input_query, answer)
+
+    async def answer_query_async(self, query, target_answer, core_system = "Rule", handle_visual = False):
+        cache_key = self.answer_cache_key(query, core_system, handle_visual)
+        if cache_key != None:
+            cached_result = answer_cache.get(cache_key)
+            if cached_result != None:
+                return cached_result
+        result = await self.compute_answer_async(query, target_answer, core_system, handle_visual)
+        if cache_key != None:
+            answer_cache.put(cache_key, result)
+        return result
+
+    async def compute_answer_async(self, query, target_answer, core_system = "Rule", handle_visual = False):
+        # Same as compute_answer, but CoreNLP, word2vec and Sempre are awaited instead of blocking a thread
+        if self.table == None:
+            raise RuntimeError("The context table for the query has not been set")
+
+        if handle_visual:
+            if self.visual_attribute_handler.spec_handler == None:
+                raise RuntimeError("The spec for the query has not been set")
+            if self.speculative and core_system == "Sempre" and self.table_file_name != None:
+                return await self.compute_answer_speculatively_async(query)
+            meta_answer = self.attempt_meta_answer(query)
+            if meta_answer != None:
+                answer, formula = meta_answer
+                return query, formula, answer
+            input_query = await self.convert_query_async(query)
         else:
-            raise RuntimeError("Unhandled core system: " + str(core_system))
\ No newline at end of file
+            input_query = query
+
+        if core_system == "Sempre":
+            if self.table_file_name == None:
+                raise RuntimeError("The table file location has not been specified")
+            answer = (await sempre_session_pool.ask_async(self.table_file_name, input_query))["answer"]
+            return self.make_sempre_result(input_query, answer)
+        else:
+            raise RuntimeError("Unhandled core system: " + str(core_system))
+
+    async def compute_answer_speculatively_async(self, query):
+        # The tasks only start at the first await, so a meta answer cancels them before they send anything
+        session_task = asyncio.ensure_future(sempre_session_pool.acquire_async(self.table_file_name))
+        convert_task = asyncio.ensure_future(self.convert_query_on_async(self.own_visual_attribute_handler(), query))
+        try:
+            meta_answer = self.attempt_meta_answer(query)
+            if meta_answer != None:
+                self.abandon(session_task, convert_task)
+                answer, formula = meta_answer
+                return query, formula, answer
+            input_query = await convert_task
+            self.converted_query = input_query
+        except BaseException:
+            self.abandon(session_task, convert_task)
+            raise
+        session, is_reused = await session_task
+        answer = (await sempre_session_pool.ask_on_session_async(self.table_file_name, input_query, session, is_reused))["answer"]
+        return self.make_sempre_result(input_query, answer)
\ No newline at end of file
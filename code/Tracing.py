@@ -0,0 +1,99 @@
+import os
+import sys
+import hmac
+import time
+import threading
+import contextlib
+import contextvars
+import collections
+
+# Trace of the request being answered, if it asked for one. Context variables follow
+# the request into asyncio tasks, but not into threads started by another request.
+_current_trace = contextvars.ContextVar("current_trace", default = None)
+
+# The profiling endpoint is disabled unless this token is set, and must then be passed along
+DEBUG_TOKEN = os.environ.get("QA_DEBUG_TOKEN")
+PROFILE_MAX_SECONDS = 60
+PROFILE_INTERVAL = 0.005
+
+class Trace:
+    def __init__(self):
+        self.start_time = time.time()
+        self.spans = []
+        self.lock = threading.Lock()
+
+    def add(self, name, start_time, end_time, error = None):
+        span = {"name": name, "startMs": round((start_time - self.start_time) * 1000.0, 3), "durationMs": round((end_time - start_time) * 1000.0, 3)}
+        if error != None:
+            span["error"] = error
+        with self.lock:
+            self.spans.append(span)
+
+    def to_list(self):
+        with self.lock:
+            return sorted(self.spans, key = lambda span: span["startMs"])
+
+@contextlib.contextmanager
+def trace():
+    # Collects the spans of everything run inside, in this context
+    request_trace = Trace()
+    token = _current_trace.set(request_trace)
+    try:
+        yield request_trace
+    finally:
+        _current_trace.reset(token)
+
+@contextlib.contextmanager
+def _record(request_trace, name):
+    start_time = time.time()
+    try:
+        yield
+    except BaseException as error:
+        request_trace.add(name, start_time, time.time(), type(error).__name__)
+        raise
+    request_trace.add(name, start_time, time.time())
+
+_disabled = contextlib.nullcontext()
+
+def span(name):
+    request_trace = _current_trace.get()
+    if request_trace == None:
+        return _disabled
+    return _record(request_trace, name)
+
+def is_debug_token(token):
+    # Compared in constant time, so that response times do not give the token away
+    if DEBUG_TOKEN == None or token == None:
+        return False
+    return hmac.compare_digest(token.encode("utf-8"), DEBUG_TOKEN.encode("utf-8"))
+
+def parse_profile_seconds(value):
+    # None unless value is a positive number of seconds; capped at PROFILE_MAX_SECONDS
+    try:
+        seconds = float(value)
+    except (TypeError, ValueError):
+        return None
+    if not seconds > 0:
+        return None
+    return min(seconds, PROFILE_MAX_SECONDS)
+
+def sample_stacks(seconds, interval = PROFILE_INTERVAL):
+    # Samples the stacks of every other thread and returns them collapsed
+    # ("thread;outer;...;inner count" per line), as read by flamegraph.pl and speedscope
+    seconds = min(seconds, PROFILE_MAX_SECONDS)
+    own_thread_id = threading.get_ident()
+    stack_counts = collections.Counter()
+    end_time = time.time() + seconds
+    while time.time() < end_time:
+        thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_thread_id:
+                continue
+            stack = []
+            while frame != None:
+                stack.append(frame.f_code.co_name + " (" + os.path.basename(frame.f_code.co_filename) + ":" + str(frame.f_code.co_firstlineno) + ")")
+                frame = frame.f_back
+            stack.append(thread_names.get(thread_id, str(thread_id)))
+            stack_counts[";".join(reversed(stack))] += 1
+        time.sleep(interval)
+    return "".join(stack + " " + str(count) + "\n" for stack, count in stack_counts.most_common())
@@ -1,24 +1,42 @@
 import json
 import re
+import asyncio
 
 import xcolors
 import SpecHandler as shandler
 import CoreNLPLayer as cnlplayer
 import word2vecLayer as w2vlayer
+import Metrics
+
+# The dictionary and lexicon are only read, so every handler in the process shares one copy
+_shared_json_files = {}
+
+def load_shared_json(file_name):
+    if not file_name in _shared_json_files:
+        with open(file_name) as json_file:
+            _shared_json_files[file_name] = json.load(json_file)
+    return _shared_json_files[file_name]
 
 class VisualAttributeHandler:
-    def __init__(self, vis_dictionary_file_name):
-        self.qparser = cnlplayer.QueryParser()
-        with open(vis_dictionary_file_name) as vis_dictionary_file:
-            self.vis_dictionary = json.load(vis_dictionary_file)
+    def __init__(self, vis_dictionary_file_name, vis_lexicon_file_name = None, qparser = None):
+        self.qparser = qparser if qparser != None else cnlplayer.QueryParser()
+        self.async_qparser = None
+        self.vis_dictionary = load_shared_json(vis_dictionary_file_name)
+        # Precomputed by word2vec/build_lexicon.py; replaces word2vec lookups when available
+        self.vis_lexicon = None
+        if vis_lexicon_file_name != None:
+            self.vis_lexicon = load_shared_json(vis_lexicon_file_name)["lexicon"]
         self.spec_handler = None
-        self.xcolors = xcolors.XColor()
+        self.xcolors = xcolors.shared_x_color
 
     def set_spec_handler(self, spec_handler):
         self.spec_handler = spec_handler
 
-    def set_spec_handler_from_file(self, dataset_name, spec_file_name, runtime_file_name, base_directory = None):
-        self.set_spec_handler(shandler.SpecHandler.from_file(dataset_name, spec_file_name, runtime_file_name, base_directory))
+    def set_spec_handler_from_file(self, dataset_name, spec_file_name, runtime_file_name, base_directory = None, use_cache = True):
+        if use_cache:
+            self.set_spec_handler(shandler.SpecHandler.from_file_cached(dataset_name, spec_file_name, runtime_file_name, base_directory))
+        else:
+            self.set_spec_handler(shandler.SpecHandler.from_file(dataset_name, spec_file_name, runtime_file_name, base_directory))
 
     def attempt_meta_answer(self, query):
         query = query.lower()
@@ -73,9 +91,28 @@ class VisualAttributeHandler:
     def convert_query(self, query):
         if self.spec_handler == None:
             raise RuntimeError("The spec handler for the query has not been set")
-        dependency_parse_tree = self.qparser.dependency_parse(query)
+        with Metrics.stage("dependency_parse"):
+            dependency_parse_tree = self.qparser.dependency_parse(query)
+        return self.convert_dependency_parse(dependency_parse_tree)
+
+    async def convert_query_async(self, query, timeout = None):
+        # Same as convert_query, but the CoreNLP parse is awaited under a deadline instead of blocking
+        if self.spec_handler == None:
+            raise RuntimeError("The spec handler for the query has not been set")
+        if self.async_qparser == None:
+            self.async_qparser = cnlplayer.get_shared_async_parser()
+        with Metrics.stage("dependency_parse"):
+            dependency_parse_tree = await self.async_qparser.dependency_parse(query, timeout)
+        # Similarities are fetched up front, so that the search itself never blocks on word2vec
+        marks = self.find_marks(dependency_parse_tree.nodes)
+        with Metrics.stage("attribute_similarities"):
+            marks_similarities = await asyncio.gather(*[self.get_attribute_similarities_async(dependency_parse_tree.nodes, mark) for mark in marks])
+        return self.convert_dependency_parse(dependency_parse_tree, dict(zip(marks, marks_similarities)))
+
+    def convert_dependency_parse(self, dependency_parse_tree, mark_attribute_similarities = None):
         dependency_parse_tree_nodes = dependency_parse_tree.nodes
-        vis_list = self.search_visual_mark(dependency_parse_tree_nodes)
+        with Metrics.stage("search_visual_mark"):
+            vis_list = self.search_visual_mark(dependency_parse_tree_nodes, mark_attribute_similarities)
         vis_list = self.search_colors_second_pass(dependency_parse_tree_nodes, vis_list)
         converted_data_list = self.map_vis2data(vis_list)
         natural_language_question = self.to_natural_language(dependency_parse_tree_nodes, converted_data_list)
@@ -104,12 +141,62 @@ class VisualAttributeHandler:
                 vis_list[token_idx] = ("color", best_color)
         return vis_list
 
-    def search_visual_mark(self, dependency_parse_tree_nodes):
+    def find_marks(self, dependency_parse_tree_nodes):
+        marks = []
+        for token_idx in range(len(dependency_parse_tree_nodes)):
+            for mark in self.spec_handler.marks.keys():
+                if dependency_parse_tree_nodes[token_idx]["lemma"] in self.vis_dictionary[mark]["mark"] and not mark in marks:
+                    marks.append(mark)
+        return marks
+
+    def get_attribute_word_lists(self, mark):
+        vis_attributes = []
+        word_lists = []
+        for vis_function in self.vis_dictionary[mark].keys():
+            if vis_function == "mark":
+                continue
+            for vis_attribute in self.vis_dictionary[mark][vis_function].keys():
+                if not vis_attribute in self.spec_handler.vis2data:
+                    continue
+                vis_attributes.append((vis_function, vis_attribute))
+                word_lists.append(self.vis_dictionary[mark][vis_function][vis_attribute])
+        return vis_attributes, word_lists
+
+    def lookup_lexicon(self, mark, vis_attributes, lemmas):
+        best_similarities = []
+        for lemma in lemmas:
+            best_similarities.append([self.vis_lexicon[mark][vis_function][vis_attribute].get(lemma, -1.0) for vis_function, vis_attribute in vis_attributes])
+        return best_similarities
+
+    def get_attribute_similarities(self, dependency_parse_tree_nodes, mark):
+        # Scores every lemma of the query against every dictionary list of the mark in one batch
+        vis_attributes, word_lists = self.get_attribute_word_lists(mark)
+        lemmas = [dependency_parse_tree_nodes[token_idx]["lemma"] for token_idx in range(len(dependency_parse_tree_nodes))]
+        if self.vis_lexicon != None:
+            best_similarities = self.lookup_lexicon(mark, vis_attributes, lemmas)
+        else:
+            best_similarities = w2vlayer.get_best_similarities_in(lemmas, word_lists)
+        return {token_idx: list(zip(vis_attributes, best_similarities[token_idx])) for token_idx in range(len(lemmas))}
+
+    async def get_attribute_similarities_async(self, dependency_parse_tree_nodes, mark):
+        vis_attributes, word_lists = self.get_attribute_word_lists(mark)
+        lemmas = [dependency_parse_tree_nodes[token_idx]["lemma"] for token_idx in range(len(dependency_parse_tree_nodes))]
+        if self.vis_lexicon != None:
+            best_similarities = self.lookup_lexicon(mark, vis_attributes, lemmas)
+        else:
+            best_similarities = await w2vlayer.get_best_similarities_in_async(lemmas, word_lists)
+        return {token_idx: list(zip(vis_attributes, best_similarities[token_idx])) for token_idx in range(len(lemmas))}
+
+    def search_visual_mark(self, dependency_parse_tree_nodes, mark_attribute_similarities = None):
         vis_list = {}
+        if mark_attribute_similarities == None:
+            mark_attribute_similarities = {}
         for token_idx in range(len(dependency_parse_tree_nodes)):
             for mark in self.spec_handler.marks.keys():
                 if dependency_parse_tree_nodes[token_idx]["lemma"] in self.vis_dictionary[mark]["mark"]:
                     vis_list[token_idx] = ("mark", None)
+                    if not mark in mark_attribute_similarities:
+                        mark_attribute_similarities[mark] = self.get_attribute_similarities(dependency_parse_tree_nodes, mark)
 
                     handled_token_idxs = []
                     token_idxs_to_handle = [token_idx]
@@ -117,16 +204,10 @@ class VisualAttributeHandler:
                         curr_token_idx = token_idxs_to_handle.pop()
                         curr_token = dependency_parse_tree_nodes[curr_token_idx]
                         best_similarity = -1.0
-                        for vis_function in self.vis_dictionary[mark].keys():
-                            if vis_function == "mark":
-                                continue
-                            for vis_attribute in self.vis_dictionary[mark][vis_function].keys():
-                                if not vis_attribute in self.spec_handler.vis2data:
-                                    continue
-                                curr_best_similarity = w2vlayer.get_best_similarity_in(curr_token["lemma"], self.vis_dictionary[mark][vis_function][vis_attribute])
-                                if curr_best_similarity > 0.75 and curr_best_similarity > best_similarity:
-                                    vis_list[curr_token_idx] = (vis_function, vis_attribute)
-                                    best_similarity = curr_best_similarity
+                        for (vis_function, vis_attribute), curr_best_similarity in mark_attribute_similarities[mark][curr_token_idx]:
+                            if curr_best_similarity > 0.75 and curr_best_similarity > best_similarity:
+                                vis_list[curr_token_idx] = (vis_function, vis_attribute)
+                                best_similarity = curr_best_similarity
                         if curr_token["lemma"] in self.xcolors.x_colors and len(self.spec_handler.color2data["mapping"]) > 0:
                             target_rgb = self.xcolors.get_rgb(curr_token["lemma"])
                             best_sqdist = 2000000
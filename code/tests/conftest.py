@@ -0,0 +1,47 @@
+import os
+import sys
+import shutil
+
+import pytest
+
+CODE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATASET_DIR = os.path.join(os.path.dirname(CODE_DIR), "dataset", "dataset")
+sys.path.insert(0, CODE_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import CoreNLPLayer as cnlplayer
+import word2vecLayer as w2vlayer
+import TableQA as tqa
+import fake_services
+
+@pytest.fixture(autouse = True)
+def code_dir(monkeypatch):
+    # The servers find the dictionary and the charts relative to code/
+    monkeypatch.chdir(CODE_DIR)
+
+@pytest.fixture
+def services(monkeypatch):
+    # Fake upstreams, and fresh clients and caches pointed at them
+    corenlp = fake_services.FakeCoreNLP().start()
+    word2vec = fake_services.FakeWord2vec().start()
+    sempre = fake_services.FakeSempre().start()
+    monkeypatch.setattr(cnlplayer.QueryParser, "CORENLP_SERVER", corenlp.url)
+    monkeypatch.setattr(cnlplayer.AsyncQueryParser, "CORENLP_SERVER", corenlp.url)
+    monkeypatch.setattr(cnlplayer, "_shared_cache", cnlplayer.ParseCache())
+    monkeypatch.setattr(cnlplayer, "_shared_async_parser", None)
+    monkeypatch.setattr(w2vlayer, "_backend", w2vlayer.HTTPBackend(word2vec.url + "/"))
+    monkeypatch.setattr(w2vlayer, "_cache", w2vlayer.SimilarityCache())
+    monkeypatch.setattr(tqa, "sempre_session_pool", tqa.SempreSessionPool(sempre.url + "/sempre"))
+    tqa.answer_cache.clear()
+    yield {"corenlp": corenlp, "word2vec": word2vec, "sempre": sempre}
+    for service in [corenlp, word2vec, sempre]:
+        service.stop()
+
+@pytest.fixture
+def chart_dir(tmp_path):
+    # One bar chart laid out like the release data: <base>/data/<dataset>/{specs,runtime-data}/
+    os.makedirs(tmp_path / "data" / "kong" / "specs")
+    os.makedirs(tmp_path / "data" / "kong" / "runtime-data")
+    shutil.copy(os.path.join(DATASET_DIR, "kong", "specs", "27.json"), tmp_path / "data" / "kong" / "specs" / "27.json")
+    shutil.copy(os.path.join(DATASET_DIR, "kong", "data", "27.csv"), tmp_path / "data" / "kong" / "runtime-data" / "27.csv")
+    return str(tmp_path) + "/"
@@ -0,0 +1,137 @@
+import re
+import json
+import time
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Minimal in-process stand-ins for CoreNLP, word2vec and Sempre, enough for the pipeline
+# to answer a question without the real services
+
+class FakeService:
+    def __init__(self):
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def respond(self, status, body):
+                body = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                parsed_url = urllib.parse.urlsplit(self.path)
+                self.respond(*service.handle("GET", parsed_url.path, dict(urllib.parse.parse_qsl(parsed_url.query)), b""))
+
+            def do_POST(self):
+                parsed_url = urllib.parse.urlsplit(self.path)
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                self.respond(*service.handle("POST", parsed_url.path, dict(urllib.parse.parse_qsl(parsed_url.query)), body))
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        # Seconds to wait before every reply
+        self.delay = 0.0
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:" + str(self.server.server_address[1])
+
+    def start(self):
+        threading.Thread(target = self.server.serve_forever, kwargs = {"poll_interval": 0.05}, daemon = True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def handle(self, method, path, params, body):
+        with self.lock:
+            self.requests += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            time.sleep(self.delay)
+            return self.reply(method, path, params, body)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+class FakeCoreNLP(FakeService):
+    # Every token is a noun attached to the first one
+    @staticmethod
+    def make_sentence(line):
+        words = re.findall(r"\w+|[^\w\s]", line)
+        tokens = [{"word": word, "lemma": word.lower(), "pos": "NN" if word[0].isalnum() else "."} for word in words]
+        dependencies = [{"dep": "ROOT" if word_idx == 0 else "dep", "governor": 0 if word_idx == 0 else 1, "dependent": word_idx + 1} for word_idx in range(len(words))]
+        parse = "(ROOT (S " + " ".join("(" + token["pos"] + " " + token["word"] + ")" for token in tokens) + "))"
+        return {"parse": parse, "basicDependencies": dependencies, "tokens": tokens}
+
+    def reply(self, method, path, params, body):
+        properties = json.loads(params.get("properties", "{}"))
+        text = body.decode("utf-8")
+        lines = text.split("\n") if properties.get("ssplit.eolonly") == "true" else [text]
+        return 200, {"sentences": [self.make_sentence(line) for line in lines]}
+
+class FakeWord2vec(FakeService):
+    PRECISION = "float32"
+
+    def __init__(self):
+        FakeService.__init__(self)
+        self.batch_requests = 0
+
+    def reply(self, method, path, params, body):
+        if path == "/stats":
+            return 200, {"precision": self.PRECISION}
+        with self.lock:
+            self.batch_requests += 1
+        parsed_json = json.loads(urllib.parse.parse_qs(body.decode("utf-8"))["stringifiedData"][0])
+        words1 = parsed_json["words1"] if "words1" in parsed_json else [parsed_json["word1"]]
+        similarities = [[1.0 if word1 == word2 else 0.0 for word2 in parsed_json["words2"]] for word1 in words1]
+        return 200, {"similarities": similarities, "unknownWords": [], "precision": self.PRECISION}
+
+class FakeSempre(FakeService):
+    # Like Sempre, a question on a session id it does not know silently opens a new session
+    # without a table, which answers nothing
+    CONTEXT_QUERY = re.compile(r"^\(context \(graph tables\.TableKnowledgeGraph (.*)/\)\)$")
+    ANSWER = {"value": "(list (name fb:cell.brazil Brazil))", "formula": "(argmax (number 1) (number 1) (fb:type.object.type fb:type.row) (reverse fb:row.row.percentage))"}
+
+    def __init__(self):
+        FakeService.__init__(self)
+        self.sessions = {}
+        self.next_session_idx = 0
+        self.context_requests = 0
+        # Set to make every question fail with an internal error
+        self.failing = False
+
+    def restart(self):
+        with self.lock:
+            self.sessions.clear()
+
+    def reply(self, method, path, params, body):
+        with self.lock:
+            session_id = params.get("sessionId")
+            if session_id == None:
+                self.next_session_idx += 1
+                session_id = "session" + str(self.next_session_idx)
+            context_match = self.CONTEXT_QUERY.match(params.get("q", ""))
+            if context_match != None:
+                self.context_requests += 1
+                self.sessions[session_id] = context_match.group(1)
+                return 200, {"sessionId": session_id}
+            if self.failing:
+                return 500, {"error": "internal error"}
+            if self.sessions.setdefault(session_id, None) == None:
+                return 200, {"sessionId": session_id}
+            return 200, {"answer": dict(self.ANSWER), "candidates": [dict(self.ANSWER)], "sessionId": session_id}
@@ -0,0 +1,43 @@
+import asyncio
+
+import pytest
+
+aiohttp = pytest.importorskip("aiohttp")
+
+import QAServer as qaserver
+import AsyncQAServer as asyncqaserver
+import CoreNLPLayer as cnlplayer
+
+QUESTION = "which country will improve the most?"
+
+@pytest.fixture
+def async_server(services, chart_dir, monkeypatch):
+    monkeypatch.setattr(qaserver, "BASE_DIR", chart_dir)
+    monkeypatch.setattr(asyncqaserver, "async_pipeline_pool", None)
+    return services
+
+def make_question(query = QUESTION, question_id = "q1"):
+    return {"query": query, "dataset": "kong", "specFile": "27.json", "runtimeFile": "27.csv", "questionId": question_id, "timeout": 10}
+
+async def ask_and_clean_up(questions):
+    try:
+        return await asyncio.gather(*[asyncqaserver.answer_question_async(question) for question in questions])
+    finally:
+        await asyncqaserver.close_client_sessions(None)
+
+def test_answers_one_question_end_to_end(async_server):
+    result = asyncio.run(asyncio.wait_for(ask_and_clean_up([make_question()]), 30))[0]
+    assert result["status"] == "ok"
+    assert result["systemAnswer"] == "Brazil"
+    assert result["questionId"] == "q1"
+    assert async_server["corenlp"].requests == 1
+    assert async_server["sempre"].context_requests == 1
+
+def test_answers_more_questions_at_once_than_the_sync_pool_holds(async_server):
+    # Distinct questions, so that none of them is answered from a cache
+    async_server["corenlp"].delay = 0.3
+    questions = [make_question("which country will improve the most in year " + str(question_idx) + "?", "q" + str(question_idx)) for question_idx in range(4 * qaserver.PIPELINE_POOL_SIZE)]
+    results = asyncio.run(asyncio.wait_for(ask_and_clean_up(questions), 30))
+    assert [result["status"] for result in results] == ["ok"] * len(questions)
+    assert async_server["corenlp"].max_in_flight > qaserver.PIPELINE_POOL_SIZE
+    assert async_server["corenlp"].max_in_flight <= cnlplayer.ASYNC_MAX_IN_FLIGHT
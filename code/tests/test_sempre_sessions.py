@@ -0,0 +1,51 @@
+import asyncio
+
+import pytest
+import requests
+
+import TableQA as tqa
+
+TABLE = "data/kong/runtime-data/27.csv"
+
+def test_reused_session_is_replaced_after_a_sempre_restart(services):
+    pool = tqa.sempre_session_pool
+    assert "answer" in pool.ask(TABLE, "which country will improve the most?")
+    services["sempre"].restart()
+    # The pooled session id now names an empty session on the restarted Sempre
+    assert "answer" in pool.ask(TABLE, "which country will improve the most?")
+    stats = pool.stats()
+    assert stats["retries"] == 1
+    assert stats["discarded"] == 1
+    assert stats["idle"] == 1
+    assert services["sempre"].context_requests == 2
+    # The replacement went back to the pool and answers without another retry
+    assert "answer" in pool.ask(TABLE, "which country will improve the most?")
+    assert pool.stats()["retries"] == 1
+
+def test_reused_session_is_replaced_after_a_sempre_restart_async(services):
+    pool = tqa.sempre_session_pool
+
+    async def ask_twice():
+        try:
+            first_reply = await pool.ask_async(TABLE, "which country will improve the most?")
+            services["sempre"].restart()
+            return first_reply, await pool.ask_async(TABLE, "which country will improve the most?")
+        finally:
+            await pool.close_async()
+
+    first_reply, second_reply = asyncio.run(ask_twice())
+    assert "answer" in first_reply and "answer" in second_reply
+    assert pool.stats()["retries"] == 1
+    assert pool.stats()["idle"] == 1
+
+def test_session_whose_reply_failed_is_not_released(services):
+    pool = tqa.sempre_session_pool
+    pool.ask(TABLE, "which country will improve the most?")
+    services["sempre"].failing = True
+    with pytest.raises(requests.HTTPError):
+        pool.ask(TABLE, "which country will improve the most?")
+    stats = pool.stats()
+    # The reused session and its replacement both failed, and neither went back to the pool
+    assert stats["retries"] == 1
+    assert stats["discarded"] == 2
+    assert stats["idle"] == 0
@@ -0,0 +1,28 @@
+import word2vecLayer as w2vlayer
+
+def test_persisted_similarities_serve_the_first_lookup_after_a_restart(services, tmp_path, monkeypatch):
+    word2vec = services["word2vec"]
+    cache_path = str(tmp_path / "similarities.db")
+    monkeypatch.setattr(w2vlayer, "_cache", w2vlayer.SimilarityCache(db_path = cache_path))
+    assert w2vlayer.get_similarity_matrix(["color", "height"], ["color"]) == [[1.0], [0.0]]
+    assert word2vec.batch_requests == 1
+    w2vlayer.get_cache().close()
+
+    # A new process: new backend, empty memory, same SQLite file
+    monkeypatch.setattr(w2vlayer, "_backend", w2vlayer.HTTPBackend(word2vec.url + "/"))
+    monkeypatch.setattr(w2vlayer, "_cache", w2vlayer.SimilarityCache(db_path = cache_path))
+    assert w2vlayer.get_similarity_matrix(["color", "height"], ["color"]) == [[1.0], [0.0]]
+    assert word2vec.batch_requests == 1
+    assert w2vlayer.get_cache_stats()["hits"] == 2
+
+def test_similarities_of_another_precision_are_not_served(services, tmp_path, monkeypatch):
+    word2vec = services["word2vec"]
+    cache_path = str(tmp_path / "similarities.db")
+    monkeypatch.setattr(w2vlayer, "_cache", w2vlayer.SimilarityCache(db_path = cache_path))
+    w2vlayer.get_similarity_matrix(["color"], ["color"])
+    w2vlayer.get_cache().close()
+
+    monkeypatch.setattr(w2vlayer, "_backend", w2vlayer.HTTPBackend(word2vec.url + "/", "int8"))
+    monkeypatch.setattr(w2vlayer, "_cache", w2vlayer.SimilarityCache(db_path = cache_path))
+    w2vlayer.get_similarity_matrix(["color"], ["color"])
+    assert word2vec.batch_requests == 2
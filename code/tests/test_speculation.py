@@ -0,0 +1,29 @@
+import time
+
+import TableQA as tqa
+import QAServer as qaserver
+
+META_QUESTION = "what is the x axis?"
+QUESTION = "which country will improve the most?"
+
+def make_pipeline(chart_dir):
+    qa_system = tqa.TableQA(qaserver.VIS_DICTIONARY_FILE_NAME, speculative = True)
+    qa_system.set_spec_handler_from_file("kong", "27.json", "27.csv", chart_dir)
+    return qa_system
+
+def test_abandoned_conversion_does_not_leak_into_the_next_request(services, chart_dir):
+    services["corenlp"].delay = 0.5
+    qa_system = make_pipeline(chart_dir)
+    # The meta answer wins, but the conversion is already waiting on CoreNLP
+    first_result = qa_system.answer_query_within(META_QUESTION, None, None, "Sempre", True)
+    assert first_result["status"] == "ok"
+    # The pipeline goes back to the pool and serves a question that runs out of time on CoreNLP,
+    # while the abandoned conversion finishes
+    while services["corenlp"].requests == 0:
+        time.sleep(0.01)
+    services["corenlp"].delay = 2.0
+    qa_system.reset()
+    qa_system.set_spec_handler_from_file("kong", "27.json", "27.csv", chart_dir)
+    second_result = qa_system.answer_query_within(QUESTION, None, 0.8, "Sempre", True)
+    assert second_result["status"] == "timeout"
+    assert second_result["visQuery"] == QUESTION
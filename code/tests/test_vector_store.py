@@ -0,0 +1,26 @@
+import os
+import sys
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "word2vec"))
+
+from vector_store import VectorStore
+
+class KeyedVectorsStandIn:
+    def __init__(self, words, vectors):
+        self.index_to_key = words
+        self.vectors = np.array(vectors, dtype = np.float32)
+        self.vector_size = self.vectors.shape[1]
+
+def test_unconverted_model_scores_like_its_store_without_copying_it():
+    keyed_vectors = KeyedVectorsStandIn(["cat", "dog", "car"], [[3.0, 4.0], [1.0, 0.0], [0.0, 2.0]])
+    raw_store = VectorStore.wrap_keyed_vectors(keyed_vectors)
+    converted_store = VectorStore.from_keyed_vectors(keyed_vectors)
+    assert raw_store.matrix is keyed_vectors.vectors
+    assert np.allclose(raw_store.similarity_matrix(["cat", "cow"], ["dog", "car"]), converted_store.similarity_matrix(["cat", "cow"], ["dog", "car"]))
+    assert raw_store.most_similar(["cat"], 2) == converted_store.most_similar(["cat"], 2)
+    # Normalizing on read leaves the model's vectors alone
+    assert keyed_vectors.vectors[0].tolist() == [3.0, 4.0]
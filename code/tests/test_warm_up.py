@@ -0,0 +1,43 @@
+import json
+
+import pytest
+
+import QAServer as qaserver
+
+@pytest.fixture
+def warm_up_charts(services, chart_dir, tmp_path, monkeypatch):
+    chart_list_file_name = tmp_path / "chart-list.json"
+    chart_list_file_name.write_text(json.dumps([{"name": "kong_27", "dataset": "kong", "filename": "27.json"}]))
+    qadata_file_name = tmp_path / "qadata.json"
+    qadata_file_name.write_text(json.dumps({"q1": {"question": "which country will improve the most?", "chartName": "kong_27"}}))
+    monkeypatch.setattr(qaserver, "CHART_LIST_FILE_NAME", str(chart_list_file_name))
+    monkeypatch.setattr(qaserver, "QADATA_FILE_NAME", str(qadata_file_name))
+    monkeypatch.setattr(qaserver, "BASE_DIR", chart_dir)
+    monkeypatch.setattr(qaserver, "pipeline_pool", qaserver.PipelinePool(1))
+    return services
+
+def get_ready(warm_up):
+    qaserver.app.testing = True
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setattr(qaserver, "warm_up", warm_up)
+        response = qaserver.app.test_client().get("/ready")
+    return response.status_code, response.get_json()
+
+def test_ready_once_the_charts_are_warm(warm_up_charts):
+    warm_up = qaserver.WarmUp()
+    assert get_ready(warm_up)[0] == 503
+    warm_up.run()
+    status, body = get_ready(warm_up)
+    assert status == 200
+    assert body["charts"] == 1
+    assert body["questions"] == 1
+
+def test_not_ready_when_no_chart_reached_sempre(warm_up_charts):
+    warm_up_charts["sempre"].stop()
+    warm_up = qaserver.WarmUp()
+    warm_up.run()
+    status, body = get_ready(warm_up)
+    assert status == 503
+    assert body["finished"]
+    assert body["failedCharts"] == ["kong_27"]
+    assert "kong_27" in body["chartErrors"]
@@ -0,0 +1,79 @@
+import argparse
+import json
+import gensim
+import numpy as np
+
+# Key parameters
+model_path = "./model/GoogleNews-vectors-negative300.bin"
+vis_dictionary_path = "../VisualAttributesDictionary.json"
+vis_lexicon_path = "../VisualAttributesLexicon.json"
+SIMILARITY_THRESH = 0.75
+RESTRICT_VOCAB = 500000
+BLOCK_SIZE = 100000
+
+def load_model(path):
+    print("Loading pre-trained model... (This will take a few minutes)")
+    if path.endswith(".bin"):
+        loaded_model = gensim.models.KeyedVectors.load_word2vec_format(path, binary=True)
+    else:
+        loaded_model = gensim.models.KeyedVectors.load(path, mmap='r')
+    print("Done loading!")
+    return loaded_model
+
+def normalize(vectors):
+    return vectors / np.maximum(np.linalg.norm(vectors, axis = 1, keepdims = True), 1e-12)
+
+def expand_word_list(model, word_list, thresh, restrict_vocab):
+    # Every vocabulary word whose best similarity to the list passes the threshold, with that similarity
+    known_words = [word for word in word_list if word in model]
+    if len(known_words) == 0:
+        return {}
+    list_vectors = normalize(model[known_words])
+    vocab_size = min(len(model.index_to_key), restrict_vocab)
+    expansion = {}
+    for block_start in range(0, vocab_size, BLOCK_SIZE):
+        block_end = min(block_start + BLOCK_SIZE, vocab_size)
+        block_vectors = normalize(np.asarray(model.vectors[block_start : block_end], dtype = np.float32))
+        best_similarities = np.dot(block_vectors, list_vectors.T).max(axis = 1)
+        for row_idx in np.nonzero(best_similarities > thresh)[0]:
+            word = model.index_to_key[block_start + row_idx]
+            if "_" in word:
+                # Phrases never show up as a single lemma
+                continue
+            # Unrounded, since rounding could bring a score down to the threshold the lookup compares against
+            expansion[word] = float(best_similarities[row_idx])
+    # Dictionary words are always looked up directly, so they must not be lost to the vocabulary cut
+    for word in known_words:
+        expansion[word] = 1.0
+    return expansion
+
+def build_lexicon(model, vis_dictionary, thresh, restrict_vocab):
+    lexicon = {}
+    for mark in vis_dictionary:
+        lexicon[mark] = {}
+        for vis_function in vis_dictionary[mark]:
+            if vis_function == "mark":
+                continue
+            lexicon[mark][vis_function] = {}
+            for vis_attribute in vis_dictionary[mark][vis_function]:
+                word_list = vis_dictionary[mark][vis_function][vis_attribute]
+                expansion = expand_word_list(model, word_list, thresh, restrict_vocab)
+                print(mark, vis_function, vis_attribute, len(expansion), "words")
+                lexicon[mark][vis_function][vis_attribute] = expansion
+    return lexicon
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Expand VisualAttributesDictionary.json into a static synonym lexicon")
+    parser.add_argument("--model", default = model_path)
+    parser.add_argument("--dictionary", default = vis_dictionary_path)
+    parser.add_argument("--output", default = vis_lexicon_path)
+    parser.add_argument("--thresh", type = float, default = SIMILARITY_THRESH)
+    parser.add_argument("--restrict-vocab", type = int, default = RESTRICT_VOCAB, help = "Only consider the most frequent words of the model")
+    args = parser.parse_args()
+
+    with open(args.dictionary) as vis_dictionary_file:
+        vis_dictionary = json.load(vis_dictionary_file)
+    lexicon = build_lexicon(load_model(args.model), vis_dictionary, args.thresh, args.restrict_vocab)
+    with open(args.output, "w") as vis_lexicon_file:
+        json.dump({"thresh": args.thresh, "restrictVocab": args.restrict_vocab, "lexicon": lexicon}, vis_lexicon_file, indent = 1, sort_keys = True)
+    print("Wrote", args.output)
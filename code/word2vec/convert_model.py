@@ -0,0 +1,89 @@
+import argparse
+import csv
+import glob
+import json
+import re
+import time
+import gensim
+
+from vector_store import VectorStore, PRECISIONS
+
+# Key parameters
+model_path = "./model/GoogleNews-vectors-negative300.bin"
+native_model_path = "./model/GoogleNews-vectors-negative300.kv"
+store_path = "./model/GoogleNews-vectors-negative300"
+vis_dictionary_path = "../VisualAttributesDictionary.json"
+qadata_path = "../../dataset/qadata.json"
+table_paths = "../../dataset/dataset/*/data/*.csv"
+
+def collect_dictionary_words(path):
+    with open(path) as vis_dictionary_file:
+        vis_dictionary = json.load(vis_dictionary_file)
+    words = set()
+    for mark in vis_dictionary:
+        for vis_function in vis_dictionary[mark]:
+            if vis_function == "mark":
+                words.update(vis_dictionary[mark][vis_function])
+                continue
+            for vis_attribute in vis_dictionary[mark][vis_function]:
+                words.update(vis_dictionary[mark][vis_function][vis_attribute])
+    return words
+
+def collect_dataset_words(qadata_file_name, table_file_pattern):
+    texts = []
+    with open(qadata_file_name) as qadata_file:
+        for qa_entry in json.load(qadata_file).values():
+            texts.append(qa_entry["question"])
+    for table_file_name in glob.glob(table_file_pattern):
+        with open(table_file_name, newline = '') as csv_file:
+            for csv_row in csv.reader(csv_file, quotechar='"', escapechar='\\'):
+                texts.extend(csv_row)
+    words = set()
+    for text in texts:
+        for word in re.findall(r"[A-Za-z][A-Za-z'-]*", text):
+            # Lemmas are mostly lowercase, but the vocabulary is case-sensitive
+            words.update([word, word.lower(), word.capitalize()])
+    return words
+
+def convert(source_path, target_path, limit = None, required_words = set(), store_precisions = []):
+    start_time = time.time()
+    print("Loading pre-trained model... (This will take a few minutes)")
+    source_model = gensim.models.KeyedVectors.load_word2vec_format(source_path, binary=True)
+    print("Loaded", len(source_model.index_to_key), "words in", round(time.time() - start_time, 1), "s")
+
+    if limit == None:
+        target_model = source_model
+    else:
+        # The most frequent words come first in the GoogleNews binary
+        kept_words = list(source_model.index_to_key[:limit])
+        kept_word_set = set(kept_words)
+        for word in sorted(required_words):
+            if word in source_model and not word in kept_word_set:
+                kept_words.append(word)
+                kept_word_set.add(word)
+        target_model = gensim.models.KeyedVectors(source_model.vector_size)
+        target_model.add_vectors(kept_words, source_model[kept_words])
+
+    # Large arrays are stored as separate .npy files, which load with mmap='r'
+    target_model.save(target_path)
+    print("Wrote", len(target_model.index_to_key), "words to", target_path)
+
+    # word2vec.py serves from the float32 store unless told otherwise
+    for precision in ["float32"] + [precision for precision in store_precisions if precision != "float32"]:
+        store = VectorStore.from_keyed_vectors(target_model, precision)
+        store.save(store_path + "." + precision)
+        print("Wrote", precision, "vector store (%.0f MB)" % (store.nbytes() / 1048576.0))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Convert the word2vec binary into gensim's memory-mappable native format")
+    parser.add_argument("--model", default = model_path)
+    parser.add_argument("--output", default = native_model_path)
+    parser.add_argument("--limit", type = int, default = None, help = "Only keep the most frequent words (plus the words the dictionary and dataset need)")
+    parser.add_argument("--no-dataset-words", action = "store_true", help = "Do not add the words of the questions and tables to the restricted vocabulary")
+    parser.add_argument("--store-precision", choices = PRECISIONS, action = "append", default = [], help = "Also write a normalized vector store for word2vec.py --precision (repeatable); float32 is always written")
+    args = parser.parse_args()
+
+    required_words = collect_dictionary_words(vis_dictionary_path)
+    if not args.no_dataset_words:
+        required_words.update(collect_dataset_words(qadata_path, table_paths))
+    convert(args.model, args.output, args.limit, required_words, args.store_precision)
@@ -0,0 +1,47 @@
+import argparse
+import numpy as np
+
+from vector_store import VectorStore
+from convert_model import collect_dictionary_words, collect_dataset_words, vis_dictionary_path, qadata_path, table_paths
+from build_lexicon import load_model, model_path
+
+SIMILARITY_THRESH = 0.75
+
+def compare(reference_store, store, words1, words2, thresh):
+    reference_similarities = reference_store.similarity_matrix(words1, words2)
+    similarities = store.similarity_matrix(words1, words2)
+    errors = np.abs(similarities - reference_similarities)
+    flipped = (similarities > thresh) != (reference_similarities > thresh)
+    near_thresh = np.abs(reference_similarities - thresh) < 0.05
+    return {
+        "pairs": reference_similarities.size,
+        "passed": int((reference_similarities > thresh).sum()),
+        "flipped": int(flipped.sum()),
+        "nearThresh": int(near_thresh.sum()),
+        "maxError": float(errors.max()),
+        "meanError": float(errors.mean())
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "How often quantized vectors change the thresholded similarity decisions")
+    parser.add_argument("--model", default = model_path)
+    parser.add_argument("--thresh", type = float, default = SIMILARITY_THRESH)
+    parser.add_argument("--random-pairs", type = int, default = 1000000, help = "Additional random word pairs among the most frequent 100000 words")
+    args = parser.parse_args()
+
+    model = load_model(args.model)
+    reference_store = VectorStore.from_keyed_vectors(model, "float32")
+    # The decisions is_similar actually makes: question and table words against dictionary words
+    dictionary_words = sorted(word for word in collect_dictionary_words(vis_dictionary_path) if word in reference_store)
+    dataset_words = sorted(word for word in collect_dataset_words(qadata_path, table_paths) if word in reference_store)
+    random_state = np.random.RandomState(0)
+    random_count = int(np.sqrt(args.random_pairs))
+    random_words1 = [reference_store.words[word_idx] for word_idx in random_state.randint(0, min(100000, len(reference_store)), random_count)]
+    random_words2 = [reference_store.words[word_idx] for word_idx in random_state.randint(0, min(100000, len(reference_store)), random_count)]
+
+    print("precision\tMB\tpair set\tpairs\tpassed\tflipped\tflip rate\tnear thresh\tmax error\tmean error")
+    for precision in ["float16", "int8"]:
+        store = VectorStore.from_keyed_vectors(model, precision)
+        for pair_set_name, words1, words2 in [("dataset x dictionary", dataset_words, dictionary_words), ("random", random_words1, random_words2)]:
+            report = compare(reference_store, store, words1, words2, args.thresh)
+            print("%s\t%.0f\t%s\t%d\t%d\t%d\t%.6f\t%d\t%.5f\t%.6f" % (precision, store.nbytes() / 1048576.0, pair_set_name, report["pairs"], report["passed"], report["flipped"], report["flipped"] / float(max(report["pairs"], 1)), report["nearThresh"], report["maxError"], report["meanError"]))
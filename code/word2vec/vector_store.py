@@ -0,0 +1,136 @@
+import json
+import numpy as np
+
+PRECISIONS = ["float32", "float16", "int8"]
+BLOCK_SIZE = 100000
+
+class VectorStore:
+    # Unit-length word vectors, so cosine similarity is a plain dot product.
+    # int8 rows are scalar-quantized with one float32 scale per row.
+    def __init__(self, words, matrix, scales = None, precision = "float32", normalized = True):
+        self.words = words
+        self.word_idxs = {word: word_idx for word_idx, word in enumerate(words)}
+        self.matrix = matrix
+        self.scales = scales
+        self.precision = precision
+        # Raw vectors (a model that was never converted) are normalized as they are read
+        self.normalized = normalized
+
+    def __contains__(self, word):
+        return word in self.word_idxs
+
+    def __len__(self):
+        return len(self.words)
+
+    def nbytes(self):
+        return self.matrix.nbytes + (self.scales.nbytes if self.scales is not None else 0)
+
+    def vectors(self, rows):
+        vectors = np.asarray(self.matrix[rows], dtype = np.float32)
+        if self.scales is not None:
+            vectors *= self.scales[rows][:, np.newaxis]
+        if not self.normalized:
+            vectors /= np.maximum(np.linalg.norm(vectors, axis = 1, keepdims = True), 1e-12)
+        return vectors
+
+    def similarity(self, word1, word2):
+        if not (word1 in self.word_idxs and word2 in self.word_idxs):
+            return 0.0
+        vectors = self.vectors([self.word_idxs[word1], self.word_idxs[word2]])
+        return float(np.dot(vectors[0], vectors[1]))
+
+    def similarity_matrix(self, words1, words2):
+        # Out-of-vocabulary words keep a similarity of 0.0
+        similarities = np.zeros((len(words1), len(words2)), dtype = np.float32)
+        known_idxs1 = [word_idx for word_idx, word in enumerate(words1) if word in self.word_idxs]
+        known_idxs2 = [word_idx for word_idx, word in enumerate(words2) if word in self.word_idxs]
+        if len(known_idxs1) == 0 or len(known_idxs2) == 0:
+            return similarities
+        vectors1 = self.vectors([self.word_idxs[words1[word_idx]] for word_idx in known_idxs1])
+        vectors2 = self.vectors([self.word_idxs[words2[word_idx]] for word_idx in known_idxs2])
+        similarities[np.ix_(known_idxs1, known_idxs2)] = np.dot(vectors1, vectors2.T)
+        return similarities
+
+    def most_similar(self, words, k = 10, candidates = None):
+        # Top-k neighbours of each query word by blocked matrix products over the vocabulary
+        # (or over the given candidate words only). Query words are not their own neighbours.
+        neighbors = [[] for word in words]
+        known_idxs = [word_idx for word_idx, word in enumerate(words) if word in self.word_idxs]
+        if len(known_idxs) == 0:
+            return neighbors
+        query_rows = np.array([self.word_idxs[words[word_idx]] for word_idx in known_idxs])
+        query_vectors = self.vectors(query_rows)
+        if candidates != None:
+            candidate_rows = np.array(sorted(set(self.word_idxs[word] for word in candidates if word in self.word_idxs)), dtype = np.int64)
+        else:
+            candidate_rows = None
+        row_count = len(candidate_rows) if candidate_rows is not None else len(self.words)
+        best_scores = np.full((len(known_idxs), 0), -np.inf, dtype = np.float32)
+        best_rows = np.zeros((len(known_idxs), 0), dtype = np.int64)
+        for block_start in range(0, row_count, BLOCK_SIZE):
+            block_end = min(block_start + BLOCK_SIZE, row_count)
+            if candidate_rows is not None:
+                block_rows = candidate_rows[block_start : block_end]
+            else:
+                block_rows = np.arange(block_start, block_end)
+            block_scores = np.dot(query_vectors, self.vectors(block_rows).T)
+            block_scores[block_rows[np.newaxis, :] == query_rows[:, np.newaxis]] = -np.inf
+            if block_scores.shape[1] > k:
+                top_cols = np.argpartition(-block_scores, k, axis = 1)[:, :k]
+            else:
+                top_cols = np.tile(np.arange(block_scores.shape[1]), (len(known_idxs), 1))
+            best_scores = np.concatenate([best_scores, np.take_along_axis(block_scores, top_cols, axis = 1)], axis = 1)
+            best_rows = np.concatenate([best_rows, block_rows[top_cols]], axis = 1)
+            if best_scores.shape[1] > k:
+                keep_cols = np.argpartition(-best_scores, k, axis = 1)[:, :k]
+                best_scores = np.take_along_axis(best_scores, keep_cols, axis = 1)
+                best_rows = np.take_along_axis(best_rows, keep_cols, axis = 1)
+        order = np.argsort(-best_scores, axis = 1)
+        for query_idx, word_idx in enumerate(known_idxs):
+            for col in order[query_idx]:
+                if np.isfinite(best_scores[query_idx, col]):
+                    neighbors[word_idx].append((self.words[best_rows[query_idx, col]], float(best_scores[query_idx, col])))
+        return neighbors
+
+    def save(self, path):
+        np.save(path + ".matrix.npy", self.matrix)
+        if self.scales is not None:
+            np.save(path + ".scales.npy", self.scales)
+        with open(path + ".json", "w") as meta_file:
+            json.dump({"precision": self.precision, "words": self.words}, meta_file)
+
+    @classmethod
+    def load(cls, path, mmap = True):
+        with open(path + ".json") as meta_file:
+            meta = json.load(meta_file)
+        mmap_mode = 'r' if mmap else None
+        matrix = np.load(path + ".matrix.npy", mmap_mode = mmap_mode)
+        scales = None
+        if meta["precision"] == "int8":
+            scales = np.load(path + ".scales.npy", mmap_mode = mmap_mode)
+        return cls(meta["words"], matrix, scales, meta["precision"])
+
+    @classmethod
+    def wrap_keyed_vectors(cls, keyed_vectors):
+        # Serves the model's own (possibly memory-mapped) matrix without copying it
+        return cls(list(keyed_vectors.index_to_key), keyed_vectors.vectors, None, "float32", normalized = False)
+
+    @classmethod
+    def from_keyed_vectors(cls, keyed_vectors, precision = "float32"):
+        if not precision in PRECISIONS:
+            raise ValueError("Unknown precision: " + str(precision))
+        words = list(keyed_vectors.index_to_key)
+        # Normalized block by block so that only the target precision is ever held in full
+        matrix = np.empty((len(words), keyed_vectors.vector_size), dtype = np.int8 if precision == "int8" else precision)
+        scales = np.empty(len(words), dtype = np.float32) if precision == "int8" else None
+        for block_start in range(0, len(words), BLOCK_SIZE):
+            block_end = min(block_start + BLOCK_SIZE, len(words))
+            block = np.asarray(keyed_vectors.vectors[block_start : block_end], dtype = np.float32)
+            block = block / np.maximum(np.linalg.norm(block, axis = 1, keepdims = True), 1e-12)
+            if precision == "int8":
+                block_scales = np.maximum(np.abs(block).max(axis = 1), 1e-12) / 127.0
+                matrix[block_start : block_end] = np.round(block / block_scales[:, np.newaxis]).astype(np.int8)
+                scales[block_start : block_end] = block_scales
+            else:
+                matrix[block_start : block_end] = block
+        return cls(words, matrix, scales, precision)
@@ -1,12 +1,47 @@
-from flask import Flask, make_response, request, jsonify
+from flask import Flask, make_response, request, jsonify, g
+import os
+import sys
 import json
+import time
+import signal
+import socket
+import argparse
+import resource
+import multiprocessing
 import gensim
 
+from vector_store import VectorStore, PRECISIONS
+
 # Key parameters
 app = Flask(__name__)
 FLASK_RUN_PORT = 5005
 model_path = "./model/GoogleNews-vectors-negative300.bin"
-model = None
+# Written by convert_model.py; loads in seconds and is shared between processes through mmap
+native_model_path = "./model/GoogleNews-vectors-negative300.kv"
+# Prefix of the normalized (and optionally quantized) stores written by convert_model.py --store-precision
+store_path = "./model/GoogleNews-vectors-negative300"
+store = None
+REPORT_INTERVAL = 60
+# Pre-fork mode only: [requests, busy seconds] per worker, in memory shared by all workers
+worker_stats = None
+worker_idx = None
+
+def make_json_response(result):
+    resp = jsonify(result)
+    resp.headers['Content-Type'] = "application/json"
+    resp.headers['Access-Control-Allow-Origin'] = "*"
+    return resp
+
+@app.before_request
+def start_request_timer():
+    g.request_start_time = time.time()
+
+@app.after_request
+def record_request(resp):
+    if worker_stats != None:
+        worker_stats[2 * worker_idx] += 1
+        worker_stats[2 * worker_idx + 1] += time.time() - g.request_start_time
+    return resp
 
 @app.route("/", methods=['POST'])
 def compute_similarity():
@@ -14,7 +49,7 @@ def compute_similarity():
     word1 = parsed_json['word1']
     word2 = parsed_json['word2']
     try:
-        similarity = model.similarity(word1, word2)
+        similarity = store.similarity(word1, word2)
     except Exception:
         similarity = 0.0
     finally:
@@ -25,17 +60,159 @@ def compute_similarity():
                 result['passedThresh'] = 1
             else:
                 result['passedThresh'] = 0
-        resp = jsonify(result)
-        resp.headers['Content-Type'] = "application/json"
-        resp.headers['Access-Control-Allow-Origin'] = "*"
-        return resp
+        return make_json_response(result)
+
+@app.route("/batch", methods=['POST'])
+def compute_similarity_matrix():
+    # One-to-many requests send "word1", many-to-many requests send "words1"
+    parsed_json = json.loads(request.form['stringifiedData'])
+    if "words1" in parsed_json:
+        words1 = parsed_json['words1']
+    else:
+        words1 = [parsed_json['word1']]
+    words2 = parsed_json['words2']
+    similarities = store.similarity_matrix(words1, words2)
+    unknown_words = [word for word in dict.fromkeys(words1 + words2) if not word in store]
+    # The precision lets clients keep the similarities of different stores apart
+    result = {"similarities": similarities.tolist(), "unknownWords": unknown_words, "precision": store.precision}
+    if "thresh" in parsed_json:
+        result['passedThresh'] = (similarities > parsed_json['thresh']).astype(int).tolist()
+    return make_json_response(result)
+
+@app.route("/neighbors", methods=['POST'])
+def compute_neighbors():
+    # Top-k neighbours for every word in "words", optionally among "candidates" only
+    parsed_json = json.loads(request.form['stringifiedData'])
+    words = parsed_json['words']
+    k = int(parsed_json.get('k', 10))
+    candidates = parsed_json.get('candidates')
+    neighbors = store.most_similar(words, k, candidates)
+    result = {
+        "neighbors": [[{"word": neighbor, "similarity": similarity} for neighbor, similarity in word_neighbors] for word_neighbors in neighbors],
+        "unknownWords": [word for word in dict.fromkeys(words) if not word in store]
+    }
+    return make_json_response(result)
+
+@app.route("/stats", methods=['GET'])
+def compute_stats():
+    result = {"pid": os.getpid(), "worker": worker_idx, "precision": store.precision, "residentMB": resident_memory_mb(), "workers": get_worker_stats()}
+    return make_json_response(result)
+
+def get_worker_stats():
+    if worker_stats == None:
+        return []
+    stats = []
+    for idx in range(len(worker_stats) // 2):
+        requests = worker_stats[2 * idx]
+        busy_seconds = worker_stats[2 * idx + 1]
+        stats.append({"worker": idx, "requests": int(requests), "busySeconds": busy_seconds, "requestsPerBusySecond": requests / busy_seconds if busy_seconds > 0 else 0.0})
+    return stats
+
+def spawn_worker(idx, listen_socket, port):
+    from werkzeug.serving import make_server
+    global worker_idx
+    pid = os.fork()
+    if pid == 0:
+        # The worker never returns into the launcher's loop, even when it fails
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            worker_idx = idx
+            make_server("127.0.0.1", port, app, fd = listen_socket.fileno()).serve_forever()
+        finally:
+            os._exit(1)
+    return pid
+
+def serve_prefork(worker_count, port = FLASK_RUN_PORT):
+    # The store is loaded before forking, so every worker reads the same pages (copy-on-write or mmap)
+    global worker_stats
+    listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listen_socket.bind(("127.0.0.1", port))
+    listen_socket.listen(128)
+    worker_stats = multiprocessing.Array('d', 2 * worker_count, lock = False)
+
+    # A process manager stops the launcher with SIGTERM; the workers must go down with it
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    worker_pids = [spawn_worker(idx, listen_socket, port) for idx in range(worker_count)]
+    print("Started", worker_count, "workers on port", port)
+
+    previous_requests = [0] * worker_count
+    try:
+        last_report_time = time.time()
+        while True:
+            time.sleep(1)
+            # Replace every worker that exited; its slot keeps counting requests
+            while True:
+                try:
+                    pid, status = os.waitpid(-1, os.WNOHANG)
+                except ChildProcessError:
+                    break
+                if pid == 0:
+                    break
+                if pid in worker_pids:
+                    idx = worker_pids.index(pid)
+                    print("worker %d (pid %d) exited with status %d, starting a new one" % (idx, pid, status))
+                    worker_pids[idx] = spawn_worker(idx, listen_socket, port)
+            if time.time() - last_report_time < REPORT_INTERVAL:
+                continue
+            last_report_time = time.time()
+            for stats in get_worker_stats():
+                throughput = (stats["requests"] - previous_requests[stats["worker"]]) / float(REPORT_INTERVAL)
+                previous_requests[stats["worker"]] = stats["requests"]
+                print("worker %d (pid %d): %d requests, %.2f req/s over the last %d s" % (stats["worker"], worker_pids[stats["worker"]], stats["requests"], throughput, REPORT_INTERVAL))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for pid in worker_pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in worker_pids:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+
+def resident_memory_mb():
+    try:
+        with open("/proc/self/status") as status_file:
+            for line in status_file:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024.0
+    except IOError:
+        pass
+    # Peak rather than current usage, in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
 
 def load_model():
-    global model
+    if os.path.exists(native_model_path):
+        print("Loading converted model...")
+        return gensim.models.KeyedVectors.load(native_model_path, mmap='r')
     print("Loading pre-trained model... (This will take a few minutes)")
-    model = gensim.models.KeyedVectors.load_word2vec_format(model_path, binary=True)
-    print("Done loading!")
+    return gensim.models.KeyedVectors.load_word2vec_format(model_path, binary=True)
+
+def load_store(precision = "float32"):
+    global store
+    start_time = time.time()
+    if os.path.exists(store_path + "." + precision + ".json"):
+        print("Loading " + precision + " vector store...")
+        store = VectorStore.load(store_path + "." + precision)
+    elif precision == "float32":
+        # Nothing is converted or written here: the model's own vectors are served and normalized as they are read
+        print("No vector store at " + store_path + ".float32, serving the model directly (convert_model.py writes one)")
+        store = VectorStore.wrap_keyed_vectors(load_model())
+    else:
+        sys.exit("No " + precision + " vector store at " + store_path + "." + precision + "; write it with: python convert_model.py --store-precision " + precision)
+    print("Done loading! (%d words, %s, %.0f MB of vectors, %.1f s, %.0f MB resident)" % (len(store), store.precision, store.nbytes() / 1048576.0, time.time() - start_time, resident_memory_mb()))
 
 if __name__ == '__main__':
-    load_model()
-    app.run(debug = True, port = FLASK_RUN_PORT)
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--precision", choices = PRECISIONS, default = "float32", help = "Storage precision of the normalized vectors")
+    parser.add_argument("--workers", type = int, default = 0, help = "Serve with this many pre-forked worker processes instead of the debug server")
+    args = parser.parse_args()
+    load_store(args.precision)
+    if args.workers > 0:
+        serve_prefork(args.workers)
+    else:
+        app.run(debug = True, port = FLASK_RUN_PORT)
\ No newline at end of file
@@ -1,24 +1,373 @@
+import os
+import sqlite3
+import threading
+import collections
 import requests
 import json
+import asyncio
+import Metrics
+import Tracing
+import Deadline
+
+WORD2VEC_SERVER = os.environ.get("WORD2VEC_SERVER", "http://localhost:5005/")
+# "http" talks to word2vec/word2vec.py, "local" memory-maps the vectors into this process
+WORD2VEC_BACKEND = os.environ.get("WORD2VEC_BACKEND", "http")
+WORD2VEC_MODEL_PATH = os.environ.get("WORD2VEC_MODEL_PATH", "./word2vec/model/GoogleNews-vectors-negative300.kv")
+# Set to a file name to keep similarities across restarts
+WORD2VEC_CACHE_PATH = os.environ.get("WORD2VEC_CACHE_PATH")
+WORD2VEC_CACHE_SIZE = int(os.environ.get("WORD2VEC_CACHE_SIZE", 100000))
+WORD2VEC_TIMEOUT = 30
+# Precision the word2vec server was started with; asked from its /stats when not set
+WORD2VEC_PRECISION = os.environ.get("WORD2VEC_PRECISION")
+WORD2VEC_STATS_TIMEOUT = 5
+# Keys per SQLite statement of a batched cache lookup
+SQLITE_CHUNK_SIZE = 400
+
+class HTTPBackend:
+	def __init__(self, server = WORD2VEC_SERVER, precision = WORD2VEC_PRECISION):
+		self.server = server
+		# Created on first use, inside the event loop
+		self.async_session = None
+		# Precision of the server's vectors, known before the first lookup so that a persisted cache
+		# serves it, and kept up to date from every answer
+		self.precision = precision if precision != None else self.fetch_precision()
+
+	def fetch_precision(self):
+		# None if the server cannot tell; the first answer then does
+		try:
+			return requests.get(self.server + "stats", timeout = WORD2VEC_STATS_TIMEOUT).json().get("precision")
+		except (requests.RequestException, ValueError):
+			return None
+
+	def cache_namespace(self):
+		# Cached similarities are only valid for the server and precision that computed them
+		if self.precision == None:
+			return None
+		return "http " + self.server + " " + self.precision
+
+	def similarity_matrix(self, words1, words2):
+		input_data = {"words1": words1, "words2": words2}
+		try:
+			similarity_response = requests.post(self.server + "batch", data = {"stringifiedData": json.dumps(input_data)}, timeout = Deadline.timeout(WORD2VEC_TIMEOUT, "word2vec"))
+		except requests.Timeout:
+			raise Deadline.DeadlineExceeded("word2vec")
+		response_json = similarity_response.json()
+		self.precision = response_json.get("precision", "unknown")
+		return response_json["similarities"], response_json["unknownWords"]
+
+	async def similarity_matrix_async(self, words1, words2):
+		import aiohttp
+		if self.async_session == None:
+			self.async_session = aiohttp.ClientSession()
+		input_data = {"words1": words1, "words2": words2}
+		try:
+			async with self.async_session.post(self.server + "batch", data = {"stringifiedData": json.dumps(input_data)}, timeout = aiohttp.ClientTimeout(total = Deadline.timeout(WORD2VEC_TIMEOUT, "word2vec"))) as similarity_response:
+				response_json = await similarity_response.json(content_type = None)
+		except asyncio.TimeoutError:
+			raise Deadline.DeadlineExceeded("word2vec")
+		self.precision = response_json.get("precision", "unknown")
+		return response_json["similarities"], response_json["unknownWords"]
+
+	async def close(self):
+		if self.async_session != None:
+			await self.async_session.close()
+			self.async_session = None
+
+class LocalBackend:
+	def __init__(self, model_path = WORD2VEC_MODEL_PATH):
+		import gensim
+		import numpy as np
+		self.np = np
+		self.model_path = model_path
+		# Opened read-only and memory-mapped, so every process on the host shares one page-cache copy
+		self.model = gensim.models.KeyedVectors.load(model_path, mmap = 'r')
+
+	def cache_namespace(self):
+		return "local " + self.model_path + " float32"
+
+	def similarity_matrix(self, words1, words2):
+		np = self.np
+		similarities = np.zeros((len(words1), len(words2)), dtype = np.float32)
+		known_idxs1 = [word_idx for word_idx, word in enumerate(words1) if word in self.model]
+		known_idxs2 = [word_idx for word_idx, word in enumerate(words2) if word in self.model]
+		unknown_words = [word for word in dict.fromkeys(words1 + words2) if not word in self.model]
+		if len(known_idxs1) == 0 or len(known_idxs2) == 0:
+			return similarities.tolist(), unknown_words
+		vectors1 = self.model[[words1[word_idx] for word_idx in known_idxs1]]
+		vectors2 = self.model[[words2[word_idx] for word_idx in known_idxs2]]
+		vectors1 = vectors1 / np.maximum(np.linalg.norm(vectors1, axis = 1, keepdims = True), 1e-12)
+		vectors2 = vectors2 / np.maximum(np.linalg.norm(vectors2, axis = 1, keepdims = True), 1e-12)
+		similarities[np.ix_(known_idxs1, known_idxs2)] = np.dot(vectors1, vectors2.T)
+		return similarities.tolist(), unknown_words
+
+	async def similarity_matrix_async(self, words1, words2):
+		# No I/O to wait for
+		return self.similarity_matrix(words1, words2)
+
+	async def close(self):
+		pass
+
+class SimilarityCache:
+	def __init__(self, max_size = WORD2VEC_CACHE_SIZE, db_path = None, max_db_size = None):
+		# Pairs are stored under a sorted key since similarity is symmetric.
+		# Out-of-vocabulary words are stored under a 1-tuple and score 0.0 against anything.
+		# Every key starts with the namespace of the backend, so that switching backends
+		# or vector precisions never serves scores computed by another one.
+		self.max_size = max_size
+		self.max_db_size = max_db_size if max_db_size != None else 10 * max_size
+		self.entries = collections.OrderedDict()
+		self.lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+		self.unknown_hits = 0
+		self.db_path = db_path
+		self.db = None
+		self.db_size = 0
+		if db_path != None:
+			self.db = sqlite3.connect(db_path, check_same_thread = False)
+			self.db.execute("CREATE TABLE IF NOT EXISTS backend_similarities (namespace TEXT, word1 TEXT, word2 TEXT, similarity REAL, PRIMARY KEY (namespace, word1, word2))")
+			self.db.execute("CREATE TABLE IF NOT EXISTS backend_unknown_words (namespace TEXT, word TEXT, PRIMARY KEY (namespace, word))")
+			self.db.commit()
+			self.db_size = self.db.execute("SELECT COUNT(*) FROM backend_similarities").fetchone()[0]
+
+	def close(self):
+		# Called before a fork: a SQLite connection must not be used or closed in a child process
+		with self.lock:
+			if self.db != None:
+				self.db.close()
+				self.db = None
+
+	def reconnect(self):
+		# Each process opens its own connection after the fork
+		with self.lock:
+			if self.db_path != None:
+				self.db = sqlite3.connect(self.db_path, check_same_thread = False)
+
+	@staticmethod
+	def pair_key(namespace, word1, word2):
+		if word1 <= word2:
+			return (namespace, word1, word2)
+		return (namespace, word2, word1)
+
+	def _remember(self, key, value):
+		self.entries[key] = value
+		self.entries.move_to_end(key)
+		while len(self.entries) > self.max_size:
+			self.entries.popitem(last = False)
+
+	def _select_many(self, query, rows):
+		# Row-value IN lists, a few hundred keys per statement to stay below SQLite's variable limit
+		results = []
+		for chunk_start in range(0, len(rows), SQLITE_CHUNK_SIZE):
+			chunk = rows[chunk_start : chunk_start + SQLITE_CHUNK_SIZE]
+			placeholders = ", ".join(["(" + ", ".join(["?"] * len(chunk[0])) + ")"] * len(chunk))
+			results += self.db.execute(query % placeholders, [value for row in chunk for value in row]).fetchall()
+		return results
+
+	def get_many(self, pairs, namespace = ""):
+		# Cached similarities of the given (word1, word2) pairs; whatever is not in memory
+		# is looked up with one query for unknown words and one for pairs
+		with self.lock:
+			words = set(word for pair in pairs for word in pair)
+			unknown_words = set(word for word in words if (namespace, word) in self.entries)
+			pair_keys = set(self.pair_key(namespace, word1, word2) for word1, word2 in pairs)
+			if self.db != None:
+				uncached_words = [(namespace, word) for word in words if not (namespace, word) in self.entries]
+				if len(uncached_words) > 0:
+					for (word,) in self._select_many("SELECT word FROM backend_unknown_words WHERE (namespace, word) IN (VALUES %s)", uncached_words):
+						self._remember((namespace, word), 0.0)
+						unknown_words.add(word)
+				uncached_keys = [key for key in pair_keys if not key in self.entries and not key[1] in unknown_words and not key[2] in unknown_words]
+				if len(uncached_keys) > 0:
+					for word1, word2, similarity in self._select_many("SELECT word1, word2, similarity FROM backend_similarities WHERE (namespace, word1, word2) IN (VALUES %s)", uncached_keys):
+						self._remember((namespace, word1, word2), similarity)
+			similarities = {}
+			for word1, word2 in pairs:
+				if word1 in unknown_words or word2 in unknown_words:
+					self.hits += 1
+					self.unknown_hits += 1
+					similarities[(word1, word2)] = 0.0
+					continue
+				key = self.pair_key(namespace, word1, word2)
+				if key in self.entries:
+					self.entries.move_to_end(key)
+					self.hits += 1
+					similarities[(word1, word2)] = self.entries[key]
+				else:
+					self.misses += 1
+			return similarities
+
+	def get(self, word1, word2, namespace = ""):
+		return self.get_many([(word1, word2)], namespace).get((word1, word2))
+
+	def put_many(self, similarities, unknown_words = [], namespace = ""):
+		with self.lock:
+			for (word1, word2), similarity in similarities.items():
+				self._remember(self.pair_key(namespace, word1, word2), similarity)
+			for word in unknown_words:
+				self._remember((namespace, word), 0.0)
+			if self.db == None:
+				return
+			pair_rows = [self.pair_key(namespace, word1, word2) + (similarity,) for (word1, word2), similarity in similarities.items()]
+			self.db.executemany("INSERT OR REPLACE INTO backend_similarities VALUES (?, ?, ?, ?)", pair_rows)
+			self.db.executemany("INSERT OR IGNORE INTO backend_unknown_words VALUES (?, ?)", [(namespace, word) for word in unknown_words])
+			self.db_size += len(pair_rows)
+			if self.db_size > self.max_db_size:
+				# Oldest insertions go first
+				self.db.execute("DELETE FROM backend_similarities WHERE rowid IN (SELECT rowid FROM backend_similarities ORDER BY rowid LIMIT ?)", (self.db_size - self.max_db_size,))
+				self.db_size = self.db.execute("SELECT COUNT(*) FROM backend_similarities").fetchone()[0]
+			self.db.commit()
+
+	def clear(self):
+		with self.lock:
+			self.entries.clear()
+			if self.db != None:
+				self.db.execute("DELETE FROM backend_similarities")
+				self.db.execute("DELETE FROM backend_unknown_words")
+				self.db.commit()
+				self.db_size = 0
+
+	def stats(self):
+		with self.lock:
+			lookups = self.hits + self.misses
+			return {
+				"hits": self.hits,
+				"misses": self.misses,
+				"unknownHits": self.unknown_hits,
+				"hitRate": self.hits / float(lookups) if lookups > 0 else 0.0,
+				"size": len(self.entries),
+				"maxSize": self.max_size,
+				"dbSize": self.db_size
+			}
+
+_backend = None
+_cache = SimilarityCache(WORD2VEC_CACHE_SIZE, WORD2VEC_CACHE_PATH)
+
+def set_backend(backend):
+	global _backend
+	_backend = backend
+
+def use_http_backend(server = WORD2VEC_SERVER):
+	set_backend(HTTPBackend(server))
+
+def use_local_backend(model_path = WORD2VEC_MODEL_PATH):
+	set_backend(LocalBackend(model_path))
+
+def set_cache(cache):
+	global _cache
+	_cache = cache
+
+def get_cache():
+	return _cache
+
+def get_cache_stats():
+	if _cache == None:
+		return None
+	return _cache.stats()
+
+def get_backend():
+	if _backend == None:
+		if WORD2VEC_BACKEND == "local":
+			use_local_backend()
+		elif WORD2VEC_BACKEND == "http":
+			use_http_backend()
+		else:
+			raise ValueError("Unknown word2vec backend: " + str(WORD2VEC_BACKEND))
+	return _backend
+
+async def close_backend_async():
+	# The HTTP backend's aiohttp session belongs to the event loop that created it
+	if _backend != None:
+		await _backend.close()
 
 def get_similarity(word1, word2):
-	input_data = {"word1": word1, "word2": word2}
-	similarity_response = requests.post("http://localhost:5005/", data = {"stringifiedData": json.dumps(input_data)})
-	return float(similarity_response.json()["similarity"])
+	return get_similarity_matrix([word1], [word2])[0][0]
 
 def is_similar(word1, word2, thresh = 0.75):
-	input_data = {"word1": word1, "word2": word2, "thresh": thresh}
-	similarity_response = requests.post("http://localhost:5005/", data = {"stringifiedData": json.dumps(input_data)})
-	return (similarity_response.json()["passedThresh"] == 1)
+	return get_similarity(word1, word2) > thresh
+
+def split_cached_pairs(words1, words2):
+	# Cached similarities, and the words that still need a backend call (duplicates only sent once)
+	unique_words1 = [word for word in dict.fromkeys(words1) if isinstance(word, str)]
+	unique_words2 = [word for word in dict.fromkeys(words2) if isinstance(word, str)]
+	pairs = [(word1, word2) for word1 in unique_words1 for word2 in unique_words2]
+	namespace = get_backend().cache_namespace()
+	# Nothing can be looked up while it is unknown which vectors the backend serves
+	unique_similarities = _cache.get_many(pairs, namespace) if _cache != None and namespace != None else {}
+	missing_words1 = []
+	missing_words2 = []
+	for word1, word2 in pairs:
+		if not (word1, word2) in unique_similarities:
+			missing_words1.append(word1)
+			missing_words2.append(word2)
+	return unique_similarities, list(dict.fromkeys(missing_words1)), list(dict.fromkeys(missing_words2))
+
+def merge_fetched_pairs(unique_similarities, missing_words1, missing_words2, missing_similarities, unknown_words):
+	fetched_similarities = {}
+	for word1_idx, word1 in enumerate(missing_words1):
+		for word2_idx, word2 in enumerate(missing_words2):
+			fetched_similarities[(word1, word2)] = float(missing_similarities[word1_idx][word2_idx])
+	namespace = get_backend().cache_namespace()
+	if _cache != None and namespace != None:
+		_cache.put_many(fetched_similarities, unknown_words, namespace)
+	unique_similarities.update(fetched_similarities)
+
+def expand_similarity_matrix(unique_similarities, words1, words2):
+	# Words that are not strings (e.g. the lemma of the root node) are never in the vocabulary
+	return [[unique_similarities.get((word1, word2), 0.0) for word2 in words2] for word1 in words1]
+
+def get_similarity_matrix(words1, words2):
+	# A single backend call for every uncached pair
+	unique_similarities, missing_words1, missing_words2 = split_cached_pairs(words1, words2)
+	if len(missing_words1) > 0:
+		with Metrics.upstream("word2vec"), Tracing.span("word2vec"):
+			missing_similarities, unknown_words = get_backend().similarity_matrix(missing_words1, missing_words2)
+		merge_fetched_pairs(unique_similarities, missing_words1, missing_words2, missing_similarities, unknown_words)
+		# Cached first, so that late similarities still serve the next request
+		Deadline.check("word2vec")
+	return expand_similarity_matrix(unique_similarities, words1, words2)
+
+async def get_similarity_matrix_async(words1, words2):
+	# The cache may go to SQLite, which must not block the event loop
+	loop = asyncio.get_running_loop()
+	unique_similarities, missing_words1, missing_words2 = await loop.run_in_executor(None, split_cached_pairs, words1, words2)
+	if len(missing_words1) > 0:
+		with Metrics.upstream("word2vec"), Tracing.span("word2vec"):
+			missing_similarities, unknown_words = await get_backend().similarity_matrix_async(missing_words1, missing_words2)
+		await loop.run_in_executor(None, merge_fetched_pairs, unique_similarities, missing_words1, missing_words2, missing_similarities, unknown_words)
+	return expand_similarity_matrix(unique_similarities, words1, words2)
+
+def get_similarities(word, word_list):
+	return get_similarity_matrix([word], word_list)[0]
 
 def get_best_similarity_in(word, word_list):
 	best_similarity = -1.0;
-	for word2 in word_list:
-		best_similarity = max(best_similarity, get_similarity(word, word2))
+	for similarity in get_similarities(word, word_list):
+		best_similarity = max(best_similarity, similarity)
 	return best_similarity
 
+def best_similarities_per_list(similarity_matrix, word_lists):
+	best_similarities = []
+	for similarities in similarity_matrix:
+		word_best_similarities = []
+		offset = 0
+		for word_list in word_lists:
+			word_best_similarities.append(max(similarities[offset : offset + len(word_list)], default = -1.0))
+			offset += len(word_list)
+		best_similarities.append(word_best_similarities)
+	return best_similarities
+
+def get_best_similarities_in(words, word_lists):
+	# For each word, the best similarity within each of the word lists (one backend call overall)
+	all_words = [word2 for word_list in word_lists for word2 in word_list]
+	return best_similarities_per_list(get_similarity_matrix(words, all_words), word_lists)
+
+async def get_best_similarities_in_async(words, word_lists):
+	all_words = [word2 for word_list in word_lists for word2 in word_list]
+	return best_similarities_per_list(await get_similarity_matrix_async(words, all_words), word_lists)
+
 def has_similar_word_in(word, word_list, thresh = 0.75):
-	for word2 in word_list:
-		if is_similar(word, word2, thresh):
+	for similarity in get_similarities(word, word_list):
+		if similarity > thresh:
 			return True
 	return False
\ No newline at end of file
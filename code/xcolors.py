@@ -850,7 +850,7 @@ class RGBColor:
 
     @staticmethod
     def get_closest_named_color(color, candidates = None):
-        x_colors = XColor()
+        x_colors = shared_x_color
         if candidates == None:
             candidates = x_colors.x_colors
 
@@ -874,4 +874,7 @@ class XColor:
             self.x_colors[color_name] = RGBColor(r, g, b)
 
     def get_rgb(self, color_name):
-        return self.x_colors[color_name]
\ No newline at end of file
+        return self.x_colors[color_name]
+
+# Read-only, so one table serves every handler (and every pre-forked worker)
+shared_x_color = XColor()